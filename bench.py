@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the per-target text hot paths in main.py.
+
+Covers adjust_caption, _norm, contains_link / URL_PATTERN,
+_extract_phrase_before_sold_out and the album lookup behind
+_delete_matching_album (_find_album_index) over indexes of 500/5k/50k records, and the delivery ledger
+check every send makes (ledger.claim) for new, recent and on-disk-only keys.
+Each benchmark reports ops/s and bytes allocated per op (tracemalloc peak).
+Also prints the retained memory per target of a full album_index, as plain
+dicts (the JSON shape) and as main's compact records.
+
+    python bench.py                 # run and compare against bench_baseline.json
+    python bench.py --save          # run and store the results as the new baseline
+    python bench.py -k album        # only benchmarks whose name contains "album"
+
+Exits with status 1 when any benchmark's ops/s drops more than --threshold
+(default 20%) below the stored baseline. Baselines are machine-specific; save
+one on the machine you compare on.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+import loadtest
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+SEED = 1234
+
+
+# ─── Corpus ────────────────────────────────────────
+_WORDS = ["Blue", "Dream", "Gelato", "Runtz", "Zkittlez", "Pink", "Rozay", "AAA", "exotic",
+          "indoor", "restock", "smalls", "premium", "fresh", "drop", "limited", "mix"]
+_EMOJI = ["🔥", "💨", "🍬", "🌈", "⚡️", "✅", "📦", "🚚"]
+# NFKC changes all of these: fullwidth digits/letters, ligatures, nbsp, superscripts, roman numerals
+_NFKC = ["９７５/Ｐ", "ﬁre", "ﬂower", " ", "²", "Ⅳ", "ＡＡＡ", "ｔａｋｅ ｆｏｒ"]
+
+
+def _price(rng):
+    kind = rng.randrange(4)
+    if kind == 0:
+        return f"{rng.randrange(400, 2500)}/P for {rng.randrange(5, 40)}"
+    if kind == 1:
+        return f"${rng.randrange(10, 90)}/ea"
+    if kind == 2:
+        return f"take for {rng.randrange(150, 900)}"
+    return f"{rng.randrange(10, 90)}.{rng.randrange(0, 99):02d}/ea"
+
+
+def make_caption(rng, n_words=40, n_prices=6, unicode_noise=True):
+    parts = []
+    for _ in range(n_words):
+        parts.append(rng.choice(_WORDS))
+        if rng.random() < 0.15:
+            parts.append(rng.choice(_EMOJI))
+        if unicode_noise and rng.random() < 0.08:
+            parts.append(rng.choice(_NFKC))
+    for _ in range(n_prices):
+        parts.insert(rng.randrange(len(parts) + 1), _price(rng))
+    return " ".join(parts)
+
+
+def make_corpus(rng):
+    return {
+        "short": [make_caption(rng, 8, 1, False) for _ in range(200)],
+        "long": [make_caption(rng, 150, 12) for _ in range(200)],
+        "many_prices": [make_caption(rng, 40, 30) for _ in range(200)],
+        "unicode": [" ".join(rng.choice(_NFKC + _EMOJI + _WORDS) for _ in range(60)) + " 975/P for 20"
+                    for _ in range(200)],
+        "links": [make_caption(rng, 30, 2) + rng.choice([" https://t.me/x/1", " www.example.com",
+                                                         " [menu](https://example.com)", ""])
+                  for _ in range(200)],
+    }
+
+
+def make_album_records(rng, n):
+    return [{"caption": make_caption(rng, 30, 3), "message_ids": [1000 + i * 10 + k for k in range(10)]}
+            for i in range(n)]
+
+
+# ─── Runner ────────────────────────────────────────
+def measure(fn, inputs, min_time=0.5):
+    """Return (ops/s, bytes allocated per op) for fn over `inputs`, best of 3 rounds."""
+    n = len(inputs)
+    for x in inputs[: min(n, 50)]:  # warm caches / regex compilation
+        fn(x)
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            for x in inputs:
+                fn(x)
+        dt = time.perf_counter() - t0
+        if dt >= min_time / 3:
+            break
+        loops *= 2
+    best = dt
+    for _ in range(2):
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            for x in inputs:
+                fn(x)
+        best = min(best, time.perf_counter() - t0)
+    ops = loops * n / best
+
+    sample = inputs[:10]  # tracemalloc slows calls down a lot; a sample is enough
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    for x in sample:
+        fn(x)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return ops, max(0, peak - base) / len(sample)
+
+
+def benchmarks(main, rng):
+    corpus = make_corpus(rng)
+    chat = -1002000000001
+    tc = main._target(chat)
+    tc.inc_pound, tc.inc_cart = 200, 15
+    out = []
+    for name, caps in corpus.items():
+        out.append((f"adjust_caption[{name}]", lambda c: main.adjust_caption(c, chat), caps))
+        out.append((f"_norm[{name}]", main._norm, caps))
+    out.append(("contains_link[links]", lambda c: main.contains_link(c, None), corpus["links"]))
+    out.append(("URL_PATTERN.search[long]", main.URL_PATTERN.search, corpus["long"]))
+    sold = [c[: rng.randrange(10, 60)] + " SOLD OUT " + c[60:] for c in corpus["long"]]
+    out.append(("_extract_phrase_before_sold_out", main._extract_phrase_before_sold_out, sold))
+
+    for size in (500, 5_000, 50_000):
+        cid = f"bench{size}"
+        recs = make_album_records(rng, size)
+        main._target(cid).albums = [main._AlbumRecord(r["caption"], r["message_ids"]) for r in recs]
+        newest = [main._norm(r["caption"])[:25] for r in recs[-20:]]
+        oldest = [main._norm(r["caption"])[:25] for r in recs[:2]]
+        out.append((f"album_lookup[{size},recent]", lambda p, cid=cid: main._find_album_index(cid, p), newest))
+        out.append((f"album_lookup[{size},miss]", lambda p, cid=cid: main._find_album_index(cid, p),
+                    ["no such album zzz"]))
+        out.append((f"album_lookup[{size},oldest]", lambda p, cid=cid: main._find_album_index(cid, p), oldest))
+
+    ledger = main.ledger
+    new = [main._ledger_key(chat, -1001, 10_000_000 + i) for i in range(200)]
+    seen = [main._ledger_key(chat, -1001, i) for i in range(200)]
+    for k in seen:
+        ledger.done(k, [k[2]])
+    out.append(("ledger_claim[new]", lambda k: ledger.claim(k) and ledger.release(k), new))
+    out.append(("ledger_claim[recent]", ledger.claim, seen))
+    out.append(("ledger_claim[disk]", lambda k: ledger._recent.pop(k) and ledger.claim(k), seen))
+    return out
+
+
+def index_memory(main, rng, n_targets=20):
+    """Retained bytes per target for a full album_index: JSON-shaped dicts vs main._AlbumRecord."""
+    recs = make_album_records(rng, main.ALBUM_INDEX_MAX)
+    # every target carries the same captions, as when their increments match; json.loads
+    # still gives each target its own string objects, like loading config.json does
+    blob = json.dumps([recs] * n_targets)
+
+    def retained(build):
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        index = build()
+        used = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        del index
+        return used / n_targets
+
+    plain = retained(lambda: json.loads(blob))
+    compact = retained(lambda: [[main._AlbumRecord(r["caption"], r["message_ids"]) for r in t]
+                                for t in json.loads(blob)])
+    return plain, compact
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-k", dest="filter", default="", help="only run benchmarks whose name contains this")
+    ap.add_argument("--save", action="store_true", help="write results to the baseline file")
+    ap.add_argument("--baseline", default=BASELINE_FILE)
+    ap.add_argument("--threshold", type=float, default=0.20, help="allowed ops/s drop vs baseline (0.2 = 20%%)")
+    ap.add_argument("--min-time", type=float, default=0.5, help="seconds per benchmark")
+    args = ap.parse_args(argv)
+
+    main = loadtest.import_main(tempfile.mkdtemp(prefix="bench_"))
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    results, regressions = {}, []
+    print(f"{'benchmark':36s} {'ops/s':>12s} {'B/op':>9s} {'vs base':>9s}")
+    for name, fn, inputs in benchmarks(main, random.Random(SEED)):
+        if args.filter not in name:
+            continue
+        ops, alloc = measure(fn, inputs, args.min_time)
+        results[name] = {"ops_per_s": ops, "bytes_per_op": alloc}
+        delta = ""
+        if name in baseline:
+            ratio = ops / baseline[name]["ops_per_s"]
+            delta = f"{(ratio - 1) * 100:+.1f}%"
+            if ratio < 1 - args.threshold:
+                regressions.append(f"{name}: {ops:,.0f} ops/s vs baseline {baseline[name]['ops_per_s']:,.0f}")
+        print(f"{name:36s} {ops:12,.0f} {alloc:9,.0f} {delta:>9s}")
+
+    if args.filter in "album_index_memory":
+        plain, compact = index_memory(main, random.Random(SEED))
+        print(f"\nalbum_index_memory ({main.ALBUM_INDEX_MAX} records/target): "
+              f"dicts {plain / 1024:,.0f} KiB/target, records {compact / 1024:,.0f} KiB/target "
+              f"({(compact / plain - 1) * 100:+.0f}%)")
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\nbaseline written to {args.baseline}")
+        return 0
+    if regressions:
+        print(f"\n❌ {len(regressions)} benchmark(s) regressed more than {args.threshold:.0%}:")
+        print("\n".join("  " + r for r in regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
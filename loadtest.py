@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+Fan-out load test against a local stand-in for the Telegram Bot API.
+
+Starts FakeBotAPI (aiohttp) on localhost, points an Application at it through
+`base_url`, and pushes synthetic source posts through main.forward_handler the
+same way polling would (via the update queue). Reports throughput, p50/p99
+delivery lag and Bot API calls per post. Nothing talks to Telegram.
+
+    python loadtest.py --targets 100 --posts 20 --album-size 10 --latency-ms 40 --rate-429 0.01
+    python loadtest.py --targets 50 --posts 5 --latency-ms 200 --drain-after 0.5   # shutdown drain
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import tempfile
+from collections import Counter
+
+from aiohttp import web
+
+FAKE_TOKEN = "123456:LOADTEST"
+SOURCE_ID  = -1001000000001
+
+
+def _dummy_session() -> str:
+    """A syntactically valid Telethon string session; it is never connected."""
+    from telethon.crypto import AuthKey
+    from telethon.sessions import StringSession
+    s = StringSession()
+    s.set_dc(2, "127.0.0.1", 443)
+    s.auth_key = AuthKey(b"\0" * 256)
+    return s.save()
+
+
+def import_main(workdir: str):
+    """
+    Import main.py with throwaway credentials and state files kept in `workdir`,
+    so a harness run never touches the real config.json / traces.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault("BOT_TOKEN", FAKE_TOKEN)
+    os.environ.setdefault("SOURCE_CHANNEL", str(SOURCE_ID))
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "loadtest")
+    os.environ.setdefault("SESSION_STRING", _dummy_session())
+    os.chdir(workdir)
+    import main
+    return main
+
+
+# ─── Fake Bot API ──────────────────────────────────
+class FakeBotAPI:
+    """
+    Minimal Bot API server: enough of getMe/sendMessage/copyMessage(s)/
+    sendMediaGroup/editMessage*/deleteMessage(s)/getChatMember/getUpdates for
+    the bot's delivery paths. Latency and 429 injection are configurable.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.02, rate_429=0.0, retry_after=1, port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.port = port
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.sent = []        # (time.time(), method, chat_id, params)
+        self.local_files = [] # (path, size) of file:// media sent by a bot in local mode
+        self.forbidden = set() # chat ids answered like a channel that kicked the bot
+        self._next_id = {}    # chat_id -> next message id
+        self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._dispatch)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _msg(self, chat_id, **extra):
+        mid = self._next_id.get(chat_id, 1)
+        self._next_id[chat_id] = mid + 1
+        return {"message_id": mid, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "channel", "title": str(chat_id)}, **extra}
+
+    async def _dispatch(self, request):
+        method = request.match_info["method"]
+        raw = await request.post() if request.can_read_body else {}
+        params = {}
+        for k, v in raw.items():
+            if not isinstance(v, str):
+                params[k] = v  # uploaded file part
+                continue
+            try:
+                params[k] = json.loads(v)
+            except ValueError:
+                params[k] = v
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            await asyncio.sleep(min(float(params.get("timeout", 0) or 0), 1.0))
+            return self._ok([])
+
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if self.rate_429 and method not in ("getMe", "getChatMember") and random.random() < self.rate_429:
+            self.throttled[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        if params.get("chat_id") in self.forbidden and method != "getMe":
+            return web.json_response({
+                "ok": False, "error_code": 403,
+                "description": "Forbidden: bot was kicked from the channel chat",
+            }, status=403)
+        if method == "getMe":
+            return self._ok(self._m_getMe(params, request.match_info["token"]))
+        handler = getattr(self, f"_m_{method}", None)
+        if handler is None:
+            return self._ok(True)
+        return self._ok(handler(params))
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    def _record(self, method, params):
+        self.sent.append((time.time(), method, params.get("chat_id"), params))
+
+    def _m_getMe(self, p, token=FAKE_TOKEN):
+        bot_id = int(token.split(":")[0])
+        return {"id": bot_id, "is_bot": True, "first_name": "loadtest", "username": f"loadtest{bot_id}_bot",
+                "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+
+    def _m_getChat(self, p):
+        return {"id": p.get("chat_id"), "type": "channel", "title": str(p.get("chat_id"))}
+
+    def _m_getChatMember(self, p):
+        return {"status": "administrator", "user": self._m_getMe(p), "can_be_edited": False,
+                "is_anonymous": False, "can_manage_chat": True, "can_delete_messages": True,
+                "can_manage_video_chats": True, "can_restrict_members": True, "can_promote_members": False,
+                "can_change_info": True, "can_invite_users": True, "can_post_messages": True,
+                "can_post_stories": True, "can_edit_stories": True, "can_delete_stories": True}
+
+    def _m_sendMessage(self, p):
+        self._record("sendMessage", p)
+        return self._msg(p["chat_id"], text=p.get("text", ""))
+
+    def _m_copyMessage(self, p):
+        self._record("copyMessage", p)
+        return {"message_id": self._msg(p["chat_id"])["message_id"]}
+
+    def _m_copyMessages(self, p):
+        self._record("copyMessages", p)
+        return [{"message_id": self._msg(p["chat_id"])["message_id"]} for _ in p.get("message_ids", [])]
+
+    def _m_sendMediaGroup(self, p):
+        self._record("sendMediaGroup", p)
+        out = []
+        for item in p.get("media", []):
+            if str(item.get("media", "")).startswith("file://"):
+                # like telegram-bot-api --local: the server reads the file itself
+                path = item["media"][len("file://"):]
+                self.local_files.append((path, os.path.getsize(path)))
+            extra = {"caption": item["caption"]} if item.get("caption") else {}
+            out.append(self._msg(p["chat_id"], media_group_id="fake", **extra))
+        return out
+
+    def _m_editMessageCaption(self, p):
+        self._record("editMessageCaption", p)
+        return {"message_id": p.get("message_id"), "date": int(time.time()),
+                "chat": {"id": p.get("chat_id"), "type": "channel"}, "caption": p.get("caption", "")}
+
+    def _m_editMessageText(self, p):
+        self._record("editMessageText", p)
+        return {"message_id": p.get("message_id"), "date": int(time.time()),
+                "chat": {"id": p.get("chat_id"), "type": "channel"}, "text": p.get("text", "")}
+
+    def _m_deleteMessage(self, p):
+        self._record("deleteMessage", p)
+        return True
+
+    def _m_deleteMessages(self, p):
+        self._record("deleteMessages", p)
+        return True
+
+
+# ─── Synthetic source posts ────────────────────────
+CAPTIONS = [
+    "Blue Dream AAA 975/P for 20 — 30/ea",
+    "Gelato #41 take for 500, 45/ea",
+    "Runtz mix 1200/P for 10 • $35/ea",
+    "Zkittlez restock 850/P",
+    "Pink Rozay — TAKE FOR 650",
+]
+
+
+def synthetic_updates(first_update_id: int, first_msg_id: int, album_size: int):
+    """Updates for one source post: an album of `album_size` photos, or a single photo."""
+    now = int(time.time())
+    chat = {"id": SOURCE_ID, "type": "channel", "title": "source"}
+    caption = random.choice(CAPTIONS)
+    gid = str(random.getrandbits(48)) if album_size > 1 else None
+    out = []
+    for i in range(max(1, album_size)):
+        post = {
+            "message_id": first_msg_id + i, "date": now, "chat": chat,
+            "photo": [{"file_id": f"PHOTO{first_msg_id + i}", "file_unique_id": f"u{first_msg_id + i}",
+                       "width": 1280, "height": 1280}],
+        }
+        if gid:
+            post["media_group_id"] = gid
+        if i == 0:
+            post["caption"] = caption
+        out.append({"update_id": first_update_id + i, "channel_post": post})
+    return out
+
+
+def build_application(main, base_url: str):
+    from telegram.ext import ApplicationBuilder, MessageHandler, filters
+    application = (
+        ApplicationBuilder()
+        .token(os.environ["BOT_TOKEN"])
+        .base_url(base_url)
+        .concurrent_updates(main._SourceOrderedProcessor(main.UPDATE_CONCURRENCY))
+        .build()
+    )
+    application.add_handler(MessageHandler(filters.ALL, main.forward_handler), group=1)
+    return application
+
+
+async def wait_idle(main, timeout: float):
+    """Wait until no album is buffered and every target lane has drained."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not main.media_buf and not main._lanes:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+def in_flight_sends(main) -> set:
+    """(source post, target) of every send waiting on the API right now."""
+    return {(first_id, chat) for first_id, tr in main._inflight.get(SOURCE_ID, {}).items()
+            for chat, t in tr["targets"].items() if "api_start" in t and "done" not in t}
+
+
+def check_drain(main, cut: int, in_flight: set) -> list[str]:
+    """
+    Problems in the state a shutdown drain left behind (empty list = consistent): every
+    delivery it cut off, including the `in_flight` sends it cancelled, must be pending,
+    in `unsent`, unclaimed in the ledger and below the high-water mark, so the next
+    start sends exactly those.
+    """
+    problems = []
+    if not in_flight:
+        problems.append("no send was in flight at the drain; lower --drain-after or raise --latency-ms")
+    pending = main._inflight.get(SOURCE_ID, {})
+    todo = main.unsent.get(str(SOURCE_ID), {"posts": {}})["posts"]
+    left = 0
+    for first_id, tr in pending.items():
+        for chat, t in tr["targets"].items():
+            if "done" in t:
+                continue
+            left += 1
+            key = main._ledger_key(chat, SOURCE_ID, first_id, tr["media_group_id"])
+            if key in main.ledger._claimed or main.ledger.sent(key):
+                problems.append(f"post {first_id} -> {chat} was cut off but its ledger entry blocks a resend")
+            if chat not in todo.get(str(first_id), []):
+                problems.append(f"post {first_id} -> {chat} was cut off but is missing from unsent")
+    for first_id, chat in in_flight:
+        tr = pending.get(first_id)
+        if tr is None or "done" in tr["targets"][chat]:
+            problems.append(f"post {first_id} -> {chat} was cancelled mid-request but counted as delivered")
+    if left != cut:
+        problems.append(f"drain reported {cut} cut off, traces show {left}")
+    if pending and main.high_water.get(str(SOURCE_ID), 0) >= min(pending):
+        problems.append(f"high_water {main.high_water[str(SOURCE_ID)]} passed pending post {min(pending)}")
+    if main._lane_tasks:
+        problems.append(f"{len(main._lane_tasks)} lane job(s) still running after the drain")
+    return problems
+
+
+def pct(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def read_trace_lags(trace_file: str):
+    lags, failed = [], 0
+    try:
+        with open(trace_file) as f:
+            for line in f:
+                rec = json.loads(line)
+                for t in rec["targets"].values():
+                    if t.get("ok"):
+                        lags.append(t["done"] - rec["arrived"])
+                    else:
+                        failed += 1
+    except FileNotFoundError:
+        pass
+    return lags, failed
+
+
+def report(args, api: FakeBotAPI, wall: float, lags, failed):
+    deliveries = len(lags)
+    print(f"\nposts={args.posts} targets={args.targets} album_size={args.album_size} tokens={getattr(args, 'tokens', 1)} "
+          f"latency={args.latency_ms}ms 429-rate={args.rate_429}")
+    print(f"wall time           : {wall:.2f}s")
+    print(f"deliveries          : {deliveries} ok, {failed} failed")
+    print(f"throughput          : {deliveries / wall:.1f} deliveries/s, {args.posts / wall:.2f} posts/s")
+    print(f"delivery lag p50/p99: {pct(lags, 50):.3f}s / {pct(lags, 99):.3f}s (update arrival -> API response)")
+    print("API calls per post  :")
+    for method, n in sorted(api.calls.items()):
+        extra = f"  ({api.throttled[method]} answered 429)" if api.throttled[method] else ""
+        print(f"  {method:20s} {n / args.posts:8.1f}{extra}")
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    os.environ["SEND_CONCURRENCY"] = str(args.send_concurrency)
+    os.environ["BOT_RATE"] = str(args.bot_rate)
+    os.environ["TRACE_FILE"] = os.path.join(workdir, "traces.jsonl")
+    os.environ["FANOUT_WORKERS"] = str(args.workers)
+    os.environ["QUEUE_DB"] = os.path.join(workdir, "fanout.sqlite")
+    main = import_main(workdir)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if not args.verbose:
+        # failed sends are counted in the report; skip their tracebacks
+        logging.getLogger("main").setLevel(logging.CRITICAL)
+    main.FLUSH_DELAY = args.flush_delay
+
+    api = await FakeBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_429, args.retry_after).start()
+    targets = [-1002000000000 - i for i in range(args.targets)]
+    main.target_chats[:] = targets
+    for chat in targets:
+        tc = main._target(chat)
+        tc.inc_pound, tc.inc_cart = main.THRESHOLD, 15
+
+    from telegram import Update
+    application = build_application(main, api.base_url)
+    await application.initialize()
+    await application.start()
+    # worker processes read these from the environment
+    extra = [f"{700000 + i}:LOADTEST" for i in range(1, args.tokens)]
+    os.environ["EXTRA_BOT_TOKENS"] = ",".join(extra)
+    os.environ["BOT_API_URL"] = main.BOT_API_URL = api.base_url
+    if args.tokens > 1:
+        main.EXTRA_BOT_TOKENS = extra
+        await main.start_bot_pool(application.bot)
+    await main.start_fanout()
+    api.forbidden.update(targets[:args.kicked])
+    api.calls.clear()
+
+    t0 = time.perf_counter()
+    update_id, msg_id = 1, 1
+    for _ in range(args.posts):
+        size = args.album_size if random.random() < args.album_ratio else 1
+        for data in synthetic_updates(update_id, msg_id, size):
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        update_id += size
+        msg_id += size
+        if args.interval:
+            await asyncio.sleep(args.interval)
+    if args.drain_after is not None:
+        # shut down mid fan-out, the way post_stop does, and check what is left for the restart
+        await asyncio.sleep(args.drain_after)
+        in_flight = in_flight_sends(main)
+        cut = await main.drain_deliveries(timeout=0)
+        problems = check_drain(main, cut, in_flight)
+    # give the processor a moment to pick up the last updates before checking for idle
+    await asyncio.sleep(0.1)
+    drained = await wait_idle(main, args.timeout)
+    wall = time.perf_counter() - t0
+
+    await application.stop()
+    await application.shutdown()
+    main.stop_fanout()
+    await main.stop_bot_pool()
+    await api.stop()
+    if not drained:
+        print(f"⚠️  lanes did not drain within {args.timeout}s; numbers below are partial")
+    lags, failed = read_trace_lags(os.environ["TRACE_FILE"])
+    report(args, api, wall, lags, failed)
+    if args.drain_after is not None:
+        print(f"drain check         : {cut} delivery(ies) cut off, {len(in_flight)} of them mid-request")
+        for p in problems:
+            print(f"  ✗ {p}")
+        if problems:
+            sys.exit(1)
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--targets", type=int, default=100)
+    ap.add_argument("--posts", type=int, default=10)
+    ap.add_argument("--album-size", type=int, default=10, help="items per album post")
+    ap.add_argument("--album-ratio", type=float, default=1.0, help="share of posts that are albums")
+    ap.add_argument("--interval", type=float, default=0.0, help="seconds between source posts")
+    ap.add_argument("--latency-ms", type=float, default=50.0)
+    ap.add_argument("--jitter-ms", type=float, default=15.0)
+    ap.add_argument("--rate-429", type=float, default=0.0, help="probability a send is answered with 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--kicked", type=int, default=0, help="targets that answer 403 (bot kicked)")
+    ap.add_argument("--send-concurrency", type=int, default=int(os.getenv("SEND_CONCURRENCY", "8")))
+    ap.add_argument("--workers", type=int, default=0, help="fan-out worker processes (0 = in-process)")
+    ap.add_argument("--tokens", type=int, default=1, help="bot tokens in the pool (primary + extras)")
+    ap.add_argument("--bot-rate", type=float, default=float(os.getenv("BOT_RATE", "25")),
+                    help="calls/s allowed per bot token")
+    ap.add_argument("--flush-delay", type=float, default=0.2, help="media_buf flush delay for the run")
+    ap.add_argument("--drain-after", type=float, default=None,
+                    help="run the shutdown drain this many seconds after the last post and check its bookkeeping")
+    ap.add_argument("--timeout", type=float, default=600.0)
+    ap.add_argument("--verbose", action="store_true", help="keep the bot's own log output")
+    return ap.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
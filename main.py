@@ -2,25 +2,50 @@ import os
 import re
 import json
 import asyncio
-import threading
+import contextlib
 import logging
 import string
+import time
+import sys
+import signal
+import sqlite3
+import shutil
+import subprocess
+import threading
+import importlib
+import zlib
+from array import array
+from functools import lru_cache, wraps
+import hmac
+import secrets
+from urllib.parse import urlparse
+from collections import OrderedDict
+from pathlib import Path
+from types import SimpleNamespace
+from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
-from flask import Flask
-from telegram import Update, InputMediaPhoto, InputMediaVideo, InputMediaDocument
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from telegram import Bot, MessageId, Update, InputMediaPhoto, InputMediaVideo, InputMediaDocument
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
-from telethon import TelegramClient
+from telegram.error import Forbidden, RetryAfter, TelegramError, TimedOut
+from telegram.request import HTTPXRequest
+from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError
+from telethon.utils import get_peer_id
 from telethon.sessions import StringSession
 
 # ─── Logging setup ──────────────────────────────────
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+_T0 = time.perf_counter()  # reference point of the startup timing log
 
 # ─── Load environment and config ────────────────────
 load_dotenv()
@@ -29,32 +54,124 @@ SOURCE_CHAT = os.getenv("SOURCE_CHANNEL")
 API_ID      = int(os.getenv("API_ID"))
 API_HASH    = os.getenv("API_HASH")
 CONFIG_FILE = "config.json"
+BOT_API_URL      = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
+BOT_API_FILE_URL = os.getenv("BOT_API_FILE_URL", "https://api.telegram.org/file/bot")
+# Self-hosted telegram-bot-api started with --local: uploads are passed as file:// paths
+# the server reads itself (no multipart, 2000 MB limit). HISTORY_TMP_DIR must then be
+# a directory the server can read at the same path. Log the bot out of the cloud API
+# (bot.log_out()) once before switching it to a self-hosted server.
+BOT_API_LOCAL    = os.getenv("BOT_API_LOCAL", "").lower() in ("1", "true", "yes")
+HISTORY_TMP_DIR  = os.getenv("HISTORY_TMP_DIR") or None
 
 # ─── Load or initialize persistent config ───────────
-target_chats = []
-inc_pound    = {}
-inc_cart     = {}
+target_chats = []  # targets of the default source; per-target settings live in targets_cfg
 text_targets = []
-album_index  = {}
+routes_cfg   = {}  # extra sources: source (as configured) -> route, see "Source routing table"
+high_water   = {}  # str(source chat id) -> last source message id delivered everywhere
+unsent       = {}  # str(source chat id) -> deliveries cut off by the last shutdown, see "Graceful shutdown"
 
 try:
     _config = json.load(open(CONFIG_FILE))
-    target_chats = _config.get("target_chats", [])
-    inc_pound    = _config.get("inc_pound", {})
-    inc_cart     = _config.get("inc_cart", {})
-    text_targets = _config.get("text_targets", [])
-    album_index  = _config.get("album_index", {})
+    high_water = _config.get("high_water", {})
+    unsent = _config.get("unsent", {})
 except:
     _config = {}
+# targets, routes and per-target settings are installed from _config by _apply_config()
+
+# Write-behind: _save_config() only marks the config dirty. Everything saved within one
+# window becomes a single atomic write (temp file + fsync + rename) on a worker thread.
+SAVE_DELAY = float(os.getenv("SAVE_DELAY", "0.5"))  # seconds mutations are coalesced for
+BACKGROUND_SAVE_DELAY = 5.0  # for bookkeeping written during fan-out (album index, high-water mark)
+_save_handle = None  # pending loop.call_at handle
+_save_task = None    # write currently running in a thread
 
-def _save_config():
-    _config["target_chats"] = target_chats
-    _config["inc_pound"]    = inc_pound
-    _config["inc_cart"]     = inc_cart
-    _config["text_targets"] = text_targets
-    _config["album_index"]  = album_index
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(_config, f, indent=2)
+def _config_snapshot() -> dict:
+    """
+    Copy the current state; runs on the event loop so it sees a consistent view.
+    Only containers are copied (album records are immutable, edits replace them):
+    encoding happens in _write_config, on the worker thread.
+    """
+    _config["target_chats"] = list(target_chats)
+    _config["targets"]      = {str(c): tc.to_json() for c, tc in targets_cfg.items()}
+    _config["text_targets"] = list(text_targets)
+    _config["album_index"]  = {str(c): list(tc.albums) for c, tc in targets_cfg.items() if tc.albums}
+    _config["routes"]       = {
+        src: {"targets": list(r["targets"]), "inc_pound": r["inc_pound"], "inc_cart": r["inc_cart"]}
+        for src, r in routes_cfg.items()
+    }
+    _config["high_water"]   = dict(high_water)
+    _config["unsent"]       = dict(unsent)
+    for legacy in ("inc_pound", "inc_cart", "target_senders"):  # replaced by "targets"
+        _config.pop(legacy, None)
+    return dict(_config)
+
+def _config_stat():
+    """Identity of the config file on disk (None if missing); changes on edit or replace."""
+    try:
+        st = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+_config_sig = _config_stat()  # the file as last read or written by us
+
+def _write_config(snapshot: dict):
+    global _config_sig
+    tmp = CONFIG_FILE + ".tmp"
+    with SAVE_CONFIG_SECONDS.time():
+        data = json.dumps(snapshot, indent=2, default=_album_record_json)
+        with open(tmp, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, CONFIG_FILE)
+    _config_sig = _config_stat()
+
+def _save_config(delay: float | None = None):
+    """Schedule a config write within `delay` seconds (default SAVE_DELAY); calls coalesce."""
+    global _save_handle
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return _write_config(_config_snapshot())  # no event loop (tools, import time)
+    when = loop.time() + (SAVE_DELAY if delay is None else delay)
+    if _save_handle is not None:
+        if _save_handle.when() <= when:
+            return
+        _save_handle.cancel()
+    _save_handle = loop.call_at(when, _start_config_write)
+
+def _start_config_write():
+    global _save_handle, _save_task
+    _save_handle = None
+    if _save_task is not None and not _save_task.done():
+        _save_config()  # one write at a time; this change goes out in the next window
+        return
+    _save_task = asyncio.ensure_future(_write_pending_config())
+    _save_task.add_done_callback(_config_write_done)
+
+async def _write_pending_config():
+    if _config_stat() not in (_config_sig, None):
+        # edited on disk since we last read/wrote it: take the edit first instead of overwriting it
+        try:
+            logger.info(f"config.json changed on disk; reloaded before saving: {await reload_config()}")
+        except ValueError as e:
+            logger.error(f"config.json on disk is invalid and will be overwritten: {e}")
+    await asyncio.to_thread(_write_config, _config_snapshot())
+
+def _config_write_done(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"config write failed: {task.exception()!r}")
+
+async def flush_config():
+    """Write pending changes now (shutdown)."""
+    global _save_handle
+    if _save_task is not None and not _save_task.done():
+        await asyncio.wait([_save_task])
+    if _save_handle is not None:
+        _save_handle.cancel()
+        _save_handle = None
+        await _write_pending_config()
 
 # ─── Constants and regex ───────────────────────────
 THRESHOLD = 200
@@ -101,17 +218,690 @@ def _hard_reason(exc: Exception) -> str:
 
 SOURCE_CHAT_ID = _chatid(SOURCE_CHAT)
 
-# ─── Flask keep-alive app ──────────────────────────
-webapp = Flask(__name__)
-@webapp.route("/")
-def ping():
-    return "OK", 200
+# ─── Per-target settings ───────────────────────────
+# One TargetConfig per target chat, keyed by _chatid(chat): ids read back from JSON
+# (strings) and ids typed into commands (ints) always land on the same entry.
+# Saved under "targets" in config.json; album records stay under "album_index".
+class TargetConfig:
+    __slots__ = ("chat", "inc_pound", "inc_cart", "sender", "priority", "breaker", "albums")
+
+    def __init__(self, chat, inc_pound: float = THRESHOLD, inc_cart: float = 15,
+                 sender: str = "bot", priority: int = 0):
+        self.chat = chat
+        self.inc_pound = inc_pound
+        self.inc_cart = inc_cart
+        self.sender = sender      # "bot" or "mtproto" (album delivery backend)
+        self.priority = priority  # higher priority targets are enqueued first in a fan-out
+        self.breaker = None       # _Breaker while the circuit breaker is open / half-open
+        self.albums = []          # _AlbumRecord list, oldest first
+
+    def to_json(self) -> dict:
+        return {"inc_pound": self.inc_pound, "inc_cart": self.inc_cart,
+                "sender": self.sender, "priority": self.priority}
+
+targets_cfg = {}  # _chatid(chat) -> TargetConfig
+
+def _target(chat) -> TargetConfig:
+    """TargetConfig of `chat`, created with the default increments if it has none yet."""
+    chat = _chatid(chat)
+    tc = targets_cfg.get(chat)
+    if tc is None:
+        tc = targets_cfg[chat] = TargetConfig(chat)
+    return tc
+
+def _target_settings(cfg: dict) -> dict:
+    """_chatid -> per-target settings of a parsed config.json, in the TargetConfig.to_json() shape."""
+    if "targets" in cfg:
+        return {_chatid(chat): s for chat, s in cfg["targets"].items()}
+    # older configs: parallel dicts, keyed by str after a JSON round trip
+    settings = {}
+    for key, field in (("inc_pound", "inc_pound"), ("inc_cart", "inc_cart"), ("target_senders", "sender")):
+        for chat, v in cfg.get(key, {}).items():
+            settings.setdefault(_chatid(chat), {})[field] = v
+    return settings
+
+# ─── Source routing table ──────────────────────────
+# Every source chat maps to a route: its own target list plus per-target increment
+# overrides (on top of the target's own TargetConfig). SOURCE_CHANNEL is the default
+# route over target_chats; further routes live under "routes" in config.json.
+# Dispatch is a dict lookup on the update's numeric chat id; @username sources are
+# resolved to ids once at startup (resolve_routes).
+def _make_route(source, cfg: dict) -> dict:
+    return {
+        "source": source,
+        "targets": [_chatid(c) for c in cfg.get("targets", [])],
+        "inc_pound": {_chatid(k): v for k, v in cfg.get("inc_pound", {}).items()},
+        "inc_cart": {_chatid(k): v for k, v in cfg.get("inc_cart", {}).items()},
+    }
+
+default_route = {"source": SOURCE_CHAT, "targets": target_chats, "inc_pound": {}, "inc_cart": {}}
+_routes = {}  # numeric source chat id -> route
+
+def _apply_config(cfg: dict):
+    """
+    Install the targets, routes and per-target settings of a parsed config.json.
+    Lists and records are updated in place, so default_route keeps its target list and
+    targets that stay keep their breaker and album records. Does not await: callers
+    on the event loop swap the whole config between two updates.
+    """
+    target_chats[:] = [_chatid(c) for c in cfg.get("target_chats", [])]
+    text_targets[:] = cfg.get("text_targets", [])
+    routes_cfg.clear()
+    routes_cfg.update({str(src): _make_route(str(src), r) for src, r in cfg.get("routes", {}).items()})
+    settings = _target_settings(cfg)
+    wanted = dict.fromkeys([*target_chats, *(c for r in routes_cfg.values() for c in r["targets"]), *settings])
+    for chat in [c for c in targets_cfg if c not in wanted]:
+        del targets_cfg[chat]
+    defaults = TargetConfig(None).to_json()
+    for chat in wanted:
+        tc = _target(chat)
+        for field, v in defaults.items():
+            setattr(tc, field, settings.get(chat, {}).get(field, v))
+
+_apply_config(_config)
+
+def _rebuild_routes(resolved: dict | None = None):
+    """Rebuild the dispatch table; `resolved` maps @username sources to their ids."""
+    resolved = resolved or {}
+    table = {}
+    for route in [default_route, *routes_cfg.values()]:
+        sid = _chatid(route["source"]) if route["source"] else None
+        sid = resolved.get(sid, sid)
+        if isinstance(sid, int):
+            if sid in table:
+                logger.warning(f"Duplicate route for source {route['source']}; keeping the first one")
+                continue
+            table[sid] = route
+    _routes.clear()
+    _routes.update(table)
+
+_rebuild_routes()
+
+async def resolve_routes(bot) -> None:
+    """Resolve @username sources to numeric ids via the Bot API, then rebuild _routes."""
+    resolved = {}
+    for route in [default_route, *routes_cfg.values()]:
+        sid = _chatid(route["source"]) if route["source"] else None
+        if sid is None or isinstance(sid, int):
+            continue
+        try:
+            resolved[sid] = (await bot.get_chat(sid)).id
+        except Exception as e:
+            logger.exception(f"Cannot resolve source {sid}: {e}")
+    _rebuild_routes(resolved)
+    logger.info(f"Routing {len(_routes)} source(s) to {len(_all_targets())} target(s)")
+
+def _all_targets() -> list[tuple]:
+    """Every distinct target as (chat, route), in route order; the first route wins."""
+    seen, out = set(), []
+    for route in [default_route, *routes_cfg.values()]:
+        for chat in route["targets"]:
+            if chat not in seen:
+                seen.add(chat)
+                out.append((chat, route))
+    return out
+
+# ─── Prometheus metrics ────────────────────────────
+SEND_SECONDS = Histogram(
+    "forwardbot_api_call_seconds", "Latency of outbound API calls per target",
+    ["method", "target"], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64),
+)
+DELIVERY_LAG = Histogram(
+    "forwardbot_delivery_lag_seconds", "Source post date to delivery in a target",
+    ["kind"], buckets=(0.5, 1, 2, 4, 8, 16, 32, 64, 128, 300, 900),
+)
+FLOOD_WAITS = Counter("forwardbot_flood_waits_total", "RetryAfter (Bot API) / FloodWait (MTProto) responses", ["api", "method"])
+API_ERRORS = Counter("forwardbot_api_errors_total", "Failed API calls by error class", ["method", "reason"])
+FALLBACK_SCAN_SECONDS = Histogram("forwardbot_fallback_scan_seconds", "Duration of Telethon history scans for album deletes")
+FALLBACK_SCAN_MESSAGES = Counter("forwardbot_fallback_scan_messages_total", "Messages read by Telethon history scans")
+DUPLICATES_SKIPPED = Counter("forwardbot_duplicate_deliveries_skipped_total",
+                             "Sends skipped because the delivery ledger already has them", ["kind"])
+EDITS_PROPAGATED = Counter("forwardbot_edits_propagated_total",
+                           "Source edits re-rendered into a target message", ["method"])
+FANOUT_RESTARTS = Counter("forwardbot_fanout_worker_restarts_total", "Fan-out worker processes restarted after exiting")
+SAVE_CONFIG_SECONDS = Histogram(
+    "forwardbot_save_config_seconds", "Duration of config writes",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+async def _api(method: str, chat, call):
+    """Await one outbound API call for `chat`, recording its latency and error class."""
+    t0 = time.perf_counter()
+    try:
+        return await call
+    except RetryAfter:
+        FLOOD_WAITS.labels("bot", method).inc()
+        API_ERRORS.labels(method, "retry_after").inc()
+        raise
+    except FloodWaitError:
+        FLOOD_WAITS.labels("mtproto", method).inc()
+        API_ERRORS.labels(method, "flood_wait").inc()
+        raise
+    except Exception as e:
+        API_ERRORS.labels(method, _hard_reason(e) or type(e).__name__).inc()
+        raise
+    finally:
+        SEND_SECONDS.labels(method, str(chat)).observe(time.perf_counter() - t0)
+
+# ─── Bot token pool ────────────────────────────────
+# Extra tokens multiply outbound capacity: each target is owned by one bot that is an
+# admin there, and every send/copy/delete for it goes through that bot's rate lane.
+# Pool bots copy posts from the source (they can't use the primary's file_ids), so a
+# bot only owns a target if it is also a member of every source that feeds it.
+EXTRA_BOT_TOKENS = [t.strip() for t in os.getenv("EXTRA_BOT_TOKENS", "").split(",") if t.strip()]
+BOT_RATE = float(os.getenv("BOT_RATE", "25"))  # outbound calls per second per token
+RETRY_AFTER_ATTEMPTS = int(os.getenv("RETRY_AFTER_ATTEMPTS", "5"))  # tries per call while answered 429
+bot_pool = []     # primary bot first, then extra bots; filled in post_init
+_target_bot = {}  # target chat -> owning bot (absent = primary)
+_rate_lanes = {}  # bot token -> _RateLane
+_source_access = {}  # (bot token, source) -> (checked_at, is a member)
+SOURCE_ACCESS_TTL = 300.0
+
+class _RateLane:
+    """Spaces one bot token's API calls to at most `rate` per second; honours RetryAfter."""
+    __slots__ = ("interval", "_next", "_lock")
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next = max(self._next, loop.time()) + self.interval
+
+    def pause(self, seconds: float):
+        self._next = max(self._next, asyncio.get_running_loop().time() + seconds)
+
+def _bot_for(chat, default):
+    return _target_bot.get(chat, default)
+
+async def _bot_call(default_bot, method: str, chat, **kwargs):
+    """Call Bot API `method` for target `chat` through its owning bot and rate lane."""
+    return await _call_with_bot(_bot_for(chat, default_bot), method, chat, **kwargs)
+
+async def _call_with_bot(bot, method: str, chat, **kwargs):
+    """
+    Call `method` through `bot`'s rate lane. A RetryAfter pauses the whole lane and the
+    call is made again once it reopens, up to RETRY_AFTER_ATTEMPTS times in all.
+    """
+    lane = _rate_lanes.get(bot.token)
+    if lane is None:
+        lane = _rate_lanes[bot.token] = _RateLane(BOT_RATE)
+    for attempt in range(1, RETRY_AFTER_ATTEMPTS + 1):
+        await lane.wait()
+        try:
+            return await _api(method, chat, getattr(bot, method)(chat_id=_chatid(chat), **kwargs))
+        except RetryAfter as e:
+            ra = e.retry_after
+            lane.pause(ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra))
+            if attempt == RETRY_AFTER_ATTEMPTS:
+                raise
+
+async def _bot_admin_status(bot, chat, bot_id: int):
+    """(status, can_delete) of `bot_id` in `chat`; raises on API errors."""
+    cm = await bot.get_chat_member(_chatid(chat), bot_id)
+    status = getattr(cm, "status", None)
+    # PTB v20+: ChatMemberAdministrator(.privileges.can_delete_messages)
+    can_del = getattr(getattr(cm, "privileges", None), "can_delete_messages", None)
+    # PTB v13 style fallback:
+    if can_del is None:
+        can_del = getattr(cm, "can_delete_messages", None)
+    return status, bool(can_del)
+
+async def _can_read_source(bot, source) -> bool:
+    """Whether `bot` is a member of `source`, i.e. can copy its posts; cached SOURCE_ACCESS_TTL."""
+    key = (bot.token, source)
+    hit = _source_access.get(key)
+    if hit is not None and time.time() - hit[0] < SOURCE_ACCESS_TTL:
+        return hit[1]
+    status, _ = await _bot_admin_status(bot, source, bot.id)  # errors are not cached
+    ok = status in ("creator", "administrator", "member")
+    _source_access[key] = (time.time(), ok)
+    return ok
+
+async def _assign_target(chat):
+    """
+    Give `chat` to the least-loaded pool bot that is an admin there and can read
+    every source feeding it (primary if none).
+    """
+    if len(bot_pool) < 2:
+        return
+    sources = {_chatid(r["source"]) for r in [default_route, *routes_cfg.values()]
+               if r["source"] and chat in r["targets"]}
+    candidates = []
+    for bot in bot_pool:
+        try:
+            status, _ = await _bot_admin_status(bot, chat, bot.id)
+            if status in ("administrator", "creator"):
+                for source in sources:
+                    if not await _can_read_source(bot, source):
+                        logger.info(f"Bot pool: @{bot.username} is not in source {source}; not given {chat}")
+                        break
+                else:
+                    candidates.append(bot)
+        except Exception:
+            continue
+    if not candidates:
+        _target_bot.pop(chat, None)
+        return
+    load = {b.token: 0 for b in candidates}
+    for c, b in _target_bot.items():
+        if c != chat and b.token in load:
+            load[b.token] += 1
+    _target_bot[chat] = min(candidates, key=lambda b: load[b.token])
+
+async def start_bot_pool(primary):
+    """Initialise extra bots and assign every target to an owning bot."""
+    bot_pool[:] = [primary]
+    for token in EXTRA_BOT_TOKENS:
+        bot = Bot(token, base_url=BOT_API_URL, base_file_url=BOT_API_FILE_URL, local_mode=BOT_API_LOCAL)
+        try:
+            await bot.initialize()
+            bot_pool.append(bot)
+        except Exception as e:
+            logger.exception(f"Extra bot token rejected: {e}")
+    if len(bot_pool) < 2:
+        return
+    sem = asyncio.Semaphore(10)
+
+    async def one(chat):
+        async with sem:
+            await _assign_target(chat)
 
-def keep_alive():
+    await asyncio.gather(*(one(chat) for chat, _r in _all_targets()))
+    counts = {b.username: 0 for b in bot_pool}
+    for chat, _r in _all_targets():
+        counts[_bot_for(chat, primary).username] += 1
+    logger.info(f"Bot pool: {counts}")
+
+async def stop_bot_pool():
+    for bot in bot_pool[1:]:
+        try:
+            await bot.shutdown()
+        except Exception as e:
+            logger.exception(f"Extra bot shutdown failed: {e}")
+
+# ─── Fan-out worker processes (FANOUT_WORKERS=K) ──────
+# The primary keeps ingesting updates and rendering captions; live deliveries are
+# written to a local SQLite queue and K worker processes (`main.py --fanout-worker i`)
+# each own the targets whose crc32 falls in their shard. A worker runs one target's
+# jobs strictly in id order, so per-target ordering holds; results flow back through
+# the same database and the primary resolves the waiting lane job.
+# The primary restarts a worker that exits; the jobs it had taken are reported as
+# TimedOut (outcome unknown, so the ledger never sends them twice), its queued jobs
+# wait for the new process. A lane gives up on a job after FANOUT_JOB_TIMEOUT. Jobs
+# left over from a previous run are dropped at start: catch_up and `unsent` resend
+# what they stood for, through the ledger. Queue I/O runs off the event loop.
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "0"))
+QUEUE_DB = os.getenv("QUEUE_DB", "fanout.sqlite")
+QUEUE_POLL = float(os.getenv("QUEUE_POLL", "0.02"))
+FANOUT_JOB_TIMEOUT = float(os.getenv("FANOUT_JOB_TIMEOUT", "300"))
+FANOUT_SUPERVISE_INTERVAL = 1.0
+
+def _shard_of(chat, shards: int) -> int:
+    return zlib.crc32(str(chat).encode()) % shards
+
+class FanoutQueue:
+    """Durable job/result tables shared by the primary and its fan-out workers."""
+
+    def __init__(self, path: str):
+        # used from asyncio.to_thread workers; the lock keeps each call's statements together
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                shard INTEGER NOT NULL, target TEXT NOT NULL, payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued', created REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS jobs_shard ON jobs (shard, status, id);
+            CREATE TABLE IF NOT EXISTS results (
+                job_id INTEGER PRIMARY KEY, ok INTEGER NOT NULL, message_ids TEXT,
+                error TEXT, seconds REAL);
+        """)
+
+    # primary side
+    def reset(self) -> int:
+        """Drop the jobs and results of a previous run; returns how many jobs were unfinished."""
+        with self.lock:
+            left = self.db.execute("SELECT COUNT(*) FROM jobs WHERE status != 'done'").fetchone()[0]
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("DELETE FROM jobs")
+            self.db.execute("DELETE FROM results")
+            self.db.execute("COMMIT")
+        return left
+
+    def put(self, shard: int, target, payload: dict) -> int:
+        with self.lock:
+            cur = self.db.execute(
+                "INSERT INTO jobs (shard, target, payload, created) VALUES (?, ?, ?, ?)",
+                (shard, str(target), json.dumps(payload, separators=(",", ":")), time.time()),
+            )
+        return cur.lastrowid
+
+    def withdraw(self, job_id: int) -> bool:
+        """Delete a job no worker has taken yet; False if it is running or finished."""
+        with self.lock:
+            return self.db.execute("DELETE FROM jobs WHERE id = ? AND status = 'queued'", (job_id,)).rowcount > 0
+
+    def fail_running(self, shard: int, error: str) -> int:
+        """Report the jobs of a dead worker's shard that it had taken as failed with `error`."""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            ids = self.db.execute("SELECT id FROM jobs WHERE shard = ? AND status = 'running'", (shard,)).fetchall()
+            self.db.executemany(
+                "INSERT OR REPLACE INTO results (job_id, ok, message_ids, error, seconds) VALUES (?, 0, '[]', ?, 0)",
+                [(i, error) for (i,) in ids])
+            self.db.executemany("UPDATE jobs SET status = 'done' WHERE id = ?", ids)
+            self.db.execute("COMMIT")
+        return len(ids)
+
+    def take_results(self) -> list[tuple]:
+        with self.lock:
+            rows = self.db.execute("SELECT job_id, ok, message_ids, error, seconds FROM results").fetchall()
+            if rows:
+                ids = [(r[0],) for r in rows]
+                self.db.execute("BEGIN")
+                self.db.executemany("DELETE FROM results WHERE job_id = ?", ids)
+                self.db.executemany("DELETE FROM jobs WHERE id = ?", ids)
+                self.db.execute("COMMIT")
+        return rows
+
+    # worker side
+    def claim(self, shard: int, limit: int = 200) -> list[tuple]:
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            rows = self.db.execute(
+                "SELECT id, target, payload FROM jobs WHERE shard = ? AND status = 'queued' ORDER BY id LIMIT ?",
+                (shard, limit),
+            ).fetchall()
+            self.db.executemany("UPDATE jobs SET status = 'running' WHERE id = ?", [(r[0],) for r in rows])
+            self.db.execute("COMMIT")
+        return rows
+
+    def finish(self, job_id: int, ok: bool, message_ids=None, error: str = "", seconds: float = 0.0):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results (job_id, ok, message_ids, error, seconds) VALUES (?, ?, ?, ?, ?)",
+                (job_id, int(ok), json.dumps(message_ids or []), error, seconds),
+            )
+            self.db.execute("UPDATE jobs SET status = 'done' WHERE id = ?", (job_id,))
+
+fanout_queue = None   # FanoutQueue on the primary when FANOUT_WORKERS > 0
+_fanout_waiters = {}  # job id -> Future resolved by _collect_results
+_fanout_procs = []    # worker process of each shard, index = shard
+_fanout_tasks = []    # _collect_results and _supervise_fanout
+_LIST_RESULTS = ("send_media_group", "copy_messages")
+
+async def _deliver(ctx, method: str, chat, **kwargs):
+    """
+    Live-delivery entry point: sends in-process, or hands the call to the fan-out
+    worker that owns `chat` and waits for its result. Returns MessageId objects
+    in place of full messages when a worker did the call.
+    """
+    if fanout_queue is None:
+        return await _bot_call(ctx.bot, method, chat, **kwargs)
+    bot = _bot_for(chat, ctx.bot)
+    if "media" in kwargs:
+        kwargs["media"] = [m.to_dict() for m in kwargs["media"]]
+    tokens = [BOT_TOKEN, *EXTRA_BOT_TOKENS]
+    payload = {"bot": tokens.index(bot.token) if bot.token in tokens else 0, "method": method, "kwargs": kwargs}
+    put = asyncio.ensure_future(asyncio.to_thread(fanout_queue.put, _shard_of(chat, FANOUT_WORKERS), chat, payload))
+    try:
+        job_id = await asyncio.shield(put)
+    except asyncio.CancelledError:
+        # the insert still completes on its thread: take the job back once it has
+        put.add_done_callback(lambda f: f.exception() is None and fanout_queue.withdraw(f.result()))
+        raise
+    fut = _fanout_waiters[job_id] = asyncio.get_running_loop().create_future()
+    try:
+        ok, ids, error, seconds = await asyncio.wait_for(fut, FANOUT_JOB_TIMEOUT)
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        _fanout_waiters.pop(job_id, None)
+        # a job no worker has taken is taken back, so it can't go out after we gave up on it
+        withdrawn = fanout_queue.withdraw(job_id)
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        if withdrawn:
+            raise TelegramError(f"fan-out job {job_id} not started within {FANOUT_JOB_TIMEOUT:.0f}s") from None
+        raise TimedOut(f"fan-out job {job_id} gave no result within {FANOUT_JOB_TIMEOUT:.0f}s") from None
+    SEND_SECONDS.labels(method, str(chat)).observe(seconds)
+    if not ok:
+        API_ERRORS.labels(method, _hard_reason(Exception(error)) or error.split(":", 1)[0]).inc()
+        raise TelegramError(error)
+    if method in _LIST_RESULTS:
+        return [MessageId(i) for i in ids]
+    return MessageId(ids[0]) if ids else None
+
+async def _collect_results():
+    while True:
+        try:
+            for job_id, ok, ids, error, seconds in await asyncio.to_thread(fanout_queue.take_results):
+                fut = _fanout_waiters.pop(job_id, None)
+                if fut is not None and not fut.done():
+                    fut.set_result((bool(ok), json.loads(ids or "[]"), error or "", seconds or 0.0))
+        except Exception as e:
+            logger.exception(f"fan-out result collection failed: {e}")
+        await asyncio.sleep(QUEUE_POLL)
+
+def _spawn_worker(shard: int) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--fanout-worker", str(shard), str(os.getpid())])
+
+async def _supervise_fanout():
+    """Restart worker processes that exit; their unfinished jobs are reported as TimedOut."""
+    while True:
+        await asyncio.sleep(FANOUT_SUPERVISE_INTERVAL)
+        for shard, p in enumerate(_fanout_procs):
+            if p.poll() is None:
+                continue
+            try:
+                lost = await asyncio.to_thread(
+                    fanout_queue.fail_running, shard, f"TimedOut: fan-out worker exited with code {p.returncode}")
+                logger.error(f"Fan-out worker {shard} exited with code {p.returncode} "
+                             f"({lost} job(s) in progress, outcome unknown); restarting it")
+                FANOUT_RESTARTS.inc()
+                _fanout_procs[shard] = _spawn_worker(shard)
+            except Exception as e:
+                logger.exception(f"restarting fan-out worker {shard} failed: {e}")
+
+async def start_fanout():
+    """Open the queue, spawn the worker processes, collect their results and watch them."""
+    global fanout_queue
+    if FANOUT_WORKERS <= 0:
+        return
+    fanout_queue = FanoutQueue(QUEUE_DB)
+    stale = await asyncio.to_thread(fanout_queue.reset)
+    if stale:
+        logger.warning(f"Fan-out: dropped {stale} unfinished job(s) of the previous run; catch-up resends them")
+    for i in range(FANOUT_WORKERS):
+        _fanout_procs.append(_spawn_worker(i))
+    loop = asyncio.get_running_loop()
+    _fanout_tasks.extend((loop.create_task(_collect_results()), loop.create_task(_supervise_fanout())))
+    logger.info(f"Fan-out: {FANOUT_WORKERS} worker process(es) on {QUEUE_DB}")
+
+def stop_fanout():
+    for task in _fanout_tasks:
+        task.cancel()  # the supervisor must not restart the workers stopped below
+    _fanout_tasks.clear()
+    for p in _fanout_procs:
+        p.terminate()
+    for p in _fanout_procs:
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+    _fanout_procs.clear()
+
+def _input_media(d: dict):
+    cls = {"photo": InputMediaPhoto, "video": InputMediaVideo}.get(d["type"], InputMediaDocument)
+    return cls(d["media"], caption=d.get("caption"))
+
+async def run_fanout_worker(shard: int, primary: int | None = None):
+    """
+    Worker process main loop: deliver this shard's jobs, one target at a time in id order.
+    Exits when the `primary` process is gone, so a restarted primary's new workers never
+    share a shard with orphans.
+    """
+    global BOT_RATE
+    BOT_RATE = BOT_RATE / max(1, FANOUT_WORKERS)  # the token's budget is shared by all workers
+    queue = FanoutQueue(QUEUE_DB)
+    bots = [Bot(tok, base_url=BOT_API_URL, base_file_url=BOT_API_FILE_URL, local_mode=BOT_API_LOCAL)
+            for tok in [BOT_TOKEN, *EXTRA_BOT_TOKENS]]
+    for bot in bots:
+        await bot.initialize()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def watch_primary():
+        while not stop.is_set():
+            if primary is not None and os.getppid() != primary:  # reparented: the primary died
+                logger.warning(f"Fan-out worker {shard}: primary {primary} is gone; exiting")
+                stop.set()
+            await asyncio.sleep(QUEUE_POLL)
+
+    async def run_target(jobs):
+        for job_id, target, payload in jobs:
+            if stop.is_set():
+                break  # the rest stay claimed; the next primary drops them at start
+            p = json.loads(payload)
+            kwargs = p["kwargs"]
+            if "media" in kwargs:
+                kwargs["media"] = [_input_media(d) for d in kwargs["media"]]
+            t0 = time.perf_counter()
+            try:
+                res = await _call_with_bot(bots[p["bot"]], p["method"], _chatid(target), **kwargs)
+                items = res if isinstance(res, (list, tuple)) else [res]
+                ids = [m.message_id for m in items if hasattr(m, "message_id")]
+                await asyncio.to_thread(queue.finish, job_id, True, ids, seconds=time.perf_counter() - t0)
+            except Exception as e:
+                logger.warning(f"worker {shard}: {p['method']} failed for {target}: {e}")
+                await asyncio.to_thread(queue.finish, job_id, False, error=f"{type(e).__name__}: {e}",
+                                        seconds=time.perf_counter() - t0)
+
+    logger.info(f"Fan-out worker {shard}/{FANOUT_WORKERS} started")
+    watcher = loop.create_task(watch_primary())
+    while not stop.is_set():
+        rows = await asyncio.to_thread(queue.claim, shard)
+        if not rows:
+            try:
+                await asyncio.wait_for(stop.wait(), QUEUE_POLL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        by_target = {}
+        for row in rows:
+            by_target.setdefault(row[1], []).append(row)
+        await asyncio.gather(*(run_target(jobs) for jobs in by_target.values()))
+    watcher.cancel()
+    for bot in bots:
+        await bot.shutdown()
+
+def _observe_lag(kind: str, src_date):
+    if src_date is not None:
+        DELIVERY_LAG.labels(kind).observe(max(0.0, time.time() - src_date.timestamp()))
+
+# ─── Health / readiness / metrics HTTP server ──────
+# Runs on the bot's own event loop (started from post_init), so probes see real state.
+READY_MAX_POLL_AGE = float(os.getenv("READY_MAX_POLL_AGE", "90"))
+_last_get_updates = 0.0  # time.time() of the last successful getUpdates round-trip
+
+BOT_UP = Gauge("forwardbot_up", "1 while the bot application is running")
+LAST_GET_UPDATES = Gauge("forwardbot_last_get_updates_timestamp_seconds", "Unix time of the last successful getUpdates")
+TARGETS_GAUGE = Gauge("forwardbot_targets", "Number of registered target chats")
+LANES_GAUGE = Gauge("forwardbot_busy_lanes", "Target lanes with queued or running deliveries")
+TARGETS_GAUGE.set_function(lambda: len(_all_targets()))
+LANES_GAUGE.set_function(lambda: len(_lanes))
+
+class _TrackedGetUpdatesRequest(HTTPXRequest):
+    """HTTPXRequest used only for getUpdates; remembers when polling last succeeded."""
+    async def do_request(self, *args, **kwargs):
+        global _last_get_updates
+        code, payload = await super().do_request(*args, **kwargs)
+        if code == 200:
+            _last_get_updates = time.time()
+            LAST_GET_UPDATES.set(_last_get_updates)
+        return code, payload
+
+web = None  # aiohttp.web, imported in a thread by start_http_server (~0.4s off the cold start)
+
+async def _healthz(request):
+    return web.Response(text="OK")
+
+async def _readyz(request):
+    problems = ["draining"] if _draining else [] if _ready_at is not None else ["starting"]
+    try:
+        if not history_client.is_connected() or not await history_client.is_user_authorized():
+            problems.append("telethon_not_authorized")
+    except Exception as e:
+        problems.append(f"telethon_error={type(e).__name__}")
+    age = time.time() - _last_get_updates
+    if WEBHOOK_URL:
+        if not _webhook_set:
+            problems.append("webhook_not_set")
+    elif not _last_get_updates:
+        problems.append("get_updates_never")
+    elif age > READY_MAX_POLL_AGE:
+        problems.append(f"get_updates_stale={age:.0f}s")
+    if problems:
+        return web.Response(status=503, text="\n".join(problems))
+    return web.Response(text="READY")
+
+async def _metrics(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+# ─── Webhook ingestion (WEBHOOK_URL=https://host/path) ─
+# Telegram POSTs updates to the same aiohttp server; main() then runs the
+# application itself (_run_webhook) instead of run_polling().
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = (urlparse(WEBHOOK_URL).path or "/webhook") if WEBHOOK_URL else None
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_ALLOWED_UPDATES = ["channel_post", "edited_channel_post", "message"]
+_webhook_app = None  # the Application updates are queued on
+_webhook_set = False
+
+async def _webhook(request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    if _draining:
+        return web.Response(status=503)  # Telegram retries; the next instance takes it
+    try:
+        update = Update.de_json(await request.json(), _webhook_app.bot)
+    except Exception:
+        return web.Response(status=400)
+    _webhook_app.update_queue.put_nowait(update)
+    return web.Response()
+
+_http_runner = None
+
+async def start_http_server():
+    global web, _http_runner
+    web = await asyncio.to_thread(importlib.import_module, "aiohttp.web")
+    http_app = web.Application()
+    http_app.router.add_get("/", _healthz)
+    http_app.router.add_get("/healthz", _healthz)
+    http_app.router.add_get("/readyz", _readyz)
+    http_app.router.add_get("/metrics", _metrics)
+    if WEBHOOK_URL:
+        http_app.router.add_post(WEBHOOK_PATH, _webhook)
     port = int(os.environ.get("PORT", 8080))
-    thread = threading.Thread(target=lambda: webapp.run(host="0.0.0.0", port=port))
-    thread.daemon = True
-    thread.start()
+    _http_runner = web.AppRunner(http_app, access_log=None)
+    await _http_runner.setup()
+    await web.TCPSite(_http_runner, host="0.0.0.0", port=port).start()
+    logger.info(f"HTTP health server listening on :{port}")
+
+async def stop_http_server():
+    if _http_runner is not None:
+        await _http_runner.cleanup()
 
     # Detect plain URLs, t.me links, and Markdown-style [text](url)
 URL_PATTERN = re.compile(
@@ -129,12 +919,19 @@ def contains_link(update_text: str, update_obj: Update) -> bool:
     return any(e.type in ("url", "text_link") for e in ent)
 
 # ─── Caption adjustment utility ────────────────────
-def adjust_caption(text: str, chat: str) -> str:
+def adjust_caption(text: str, chat: str, route: dict | None = None) -> str:
+    tc = targets_cfg.get(chat)
+    pound, cart = (tc.inc_pound, tc.inc_cart) if tc is not None else (THRESHOLD, 15)
+    if route is not None and route is not default_route:
+        # per-route increment profile overrides the target's global increments
+        pound = route["inc_pound"].get(chat, pound)
+        cart = route["inc_cart"].get(chat, cart)
+
     # Adjust things like "$30/ea" or "975/P for 20"
     def repl_slashprice(m):
         prefix, orig = m.group(1), m.group(2)
         val = float(orig)
-        inc = inc_pound.get(chat, THRESHOLD) if val > THRESHOLD else inc_cart.get(chat, 15)
+        inc = pound if val > THRESHOLD else cart
         new_val = val + inc
         if '.' in orig:
             dec_len = len(orig.split('.')[-1])
@@ -147,7 +944,7 @@ def adjust_caption(text: str, chat: str) -> str:
     def repl_takefor(m):
         lead, prefix, orig = m.group(1), m.group(2), m.group(3)
         val = float(orig)
-        inc = inc_pound.get(chat, THRESHOLD) if val > THRESHOLD else inc_cart.get(chat, 15)
+        inc = pound if val > THRESHOLD else cart
         new_val = val + inc
         if '.' in orig:
             dec_len = len(orig.split('.')[-1])
@@ -162,14 +959,53 @@ def adjust_caption(text: str, chat: str) -> str:
     out = _pattern_takefor.sub(repl_takefor, out)
     return out
 
+# Each target keeps up to 500 album records (TargetConfig.albums). Targets with the same
+# increments get the same caption, so captions are interned and normalized once, and message
+# ids are packed into array('q'). On disk a record is still {"caption": ..., "message_ids": [...]}.
+ALBUM_INDEX_MAX = 500
+
+@lru_cache(maxsize=4096)
+def _norm_caption(caption: str) -> str:
+    return sys.intern(_norm(caption.strip()))
+
+class _AlbumRecord:
+    __slots__ = ("caption", "norm", "message_ids")
+
+    def __init__(self, caption: str, message_ids):
+        self.caption = sys.intern(caption or "")
+        self.norm = _norm_caption(self.caption)
+        self.message_ids = array("q", message_ids)
+
+def _album_record_json(obj):
+    if isinstance(obj, _AlbumRecord):
+        return {"caption": obj.caption, "message_ids": obj.message_ids.tolist()}
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+for _cid, _recs in _config.get("album_index", {}).items():
+    if _chatid(_cid) in targets_cfg:  # records of removed targets are dropped
+        targets_cfg[_chatid(_cid)].albums = [
+            _AlbumRecord(r.get("caption"), r.get("message_ids") or []) for r in _recs]
+
+def _album_records(chat) -> list:
+    tc = targets_cfg.get(chat)
+    return tc.albums if tc is not None else []
+
 def _add_album_record(chat: str, caption: str, message_ids: list[int]):
-    cid = str(chat)
-    album_index.setdefault(cid, [])
-    album_index[cid].append({"caption": caption or "", "message_ids": message_ids})
-    # keep only the last N records per channel (e.g., 500)
-    if len(album_index[cid]) > 500:
-        album_index[cid] = album_index[cid][-500:]
-    _save_config()
+    recs = _target(chat).albums
+    recs.append(_AlbumRecord(caption, message_ids))
+    # keep only the last ALBUM_INDEX_MAX records per channel
+    if len(recs) > ALBUM_INDEX_MAX:
+        del recs[:-ALBUM_INDEX_MAX]
+    _save_config(BACKGROUND_SAVE_DELAY)
+
+def _update_album_record(chat, message_id: int, caption: str):
+    """Re-index the album containing target message `message_id` under its edited caption."""
+    recs = _album_records(chat)
+    for idx in range(len(recs) - 1, -1, -1):
+        if message_id in recs[idx].message_ids:
+            recs[idx] = _AlbumRecord(caption, recs[idx].message_ids)
+            _save_config(BACKGROUND_SAVE_DELAY)
+            return
 
 def _extract_phrase_before_sold_out(text: str) -> str:
     i = text.lower().find("sold out")
@@ -177,33 +1013,38 @@ def _extract_phrase_before_sold_out(text: str) -> str:
         return ""
     return text[:i].strip()
 
+def _find_album_index(chat, phrase: str) -> int:
+    """Position of the most-recent indexed album in `chat` whose caption contains `phrase`, else -1."""
+    recs = _album_records(chat)
+    phrase_norm = _norm(phrase)
+    for idx in range(len(recs) - 1, -1, -1):
+        rec = recs[idx]
+        if phrase_norm in rec.norm and rec.message_ids:
+            return idx
+    return -1
+
 async def _delete_matching_album(ctx: ContextTypes.DEFAULT_TYPE, chat: str, phrase: str) -> bool:
     """
     Use our local index to find the most-recent album whose caption starts with `phrase`.
     Delete all messages in that album via the bot and remove from index.
     """
-    cid = str(chat)
-    if cid not in album_index or not album_index[cid]:
+    idx = _find_album_index(chat, phrase)
+    if idx < 0:
         return False
 
-    phrase_norm = phrase.lower().strip()
-    for idx in range(len(album_index[cid]) - 1, -1, -1):
-        rec = album_index[cid][idx]
-        cap = (rec.get("caption") or "").strip()
-        if _norm(phrase) in _norm(cap) and rec.get("message_ids"):            
-            deleted_any = False
-            for mid in rec["message_ids"]:
-                try:
-                    await ctx.bot.delete_message(chat_id=_chatid(chat), message_id=mid)
-                    deleted_any = True
-                except Exception as e:
-                    logger.exception(f"Index delete failed for {chat} mid={mid}: {e}")
-            album_index[cid].pop(idx)
-            _save_config()
-            if deleted_any:
-                logger.info(f"Indexed delete OK in {chat}: {rec['message_ids']}")
-            return deleted_any
-    return False
+    # take it out before awaiting: live deliveries may append/trim this list meanwhile
+    rec = _album_records(chat).pop(idx)
+    deleted_any = False
+    for mid in rec.message_ids:
+        try:
+            await _bot_call(ctx.bot, "delete_message", chat, message_id=mid)
+            deleted_any = True
+        except Exception as e:
+            logger.exception(f"Index delete failed for {chat} mid={mid}: {e}")
+    _save_config()
+    if deleted_any:
+        logger.info(f"Indexed delete OK in {chat}: {rec.message_ids.tolist()}")
+    return deleted_any
 
 HISTORY_SCAN_LIMIT = 800  # recent messages per target to search in fallback
 
@@ -232,13 +1073,22 @@ async def _delete_matching_album_fallback(ctx: ContextTypes.DEFAULT_TYPE, chat:
 
     # Collect recent media albums
     groups = {}  # grouped_id -> [Message,...]
-    async for m in history_client.iter_messages(tgt, limit=HISTORY_SCAN_LIMIT):
-        if not (m.photo or m.video or m.document):
-            continue
-        gid = m.grouped_id or None
-        if gid is None:
-            continue  # not an album
-        groups.setdefault(gid, []).append(m)
+    scanned = 0
+    with FALLBACK_SCAN_SECONDS.time():
+        try:
+            async for m in history_client.iter_messages(tgt, limit=HISTORY_SCAN_LIMIT):
+                scanned += 1
+                if not (m.photo or m.video or m.document):
+                    continue
+                gid = m.grouped_id or None
+                if gid is None:
+                    continue  # not an album
+                groups.setdefault(gid, []).append(m)
+        except FloodWaitError:
+            FLOOD_WAITS.labels("mtproto", "iter_messages").inc()
+            raise
+        finally:
+            FALLBACK_SCAN_MESSAGES.inc(scanned)
 
     phrase_norm = (phrase or "").strip().lower()
     if not phrase_norm or not groups:
@@ -256,7 +1106,7 @@ async def _delete_matching_album_fallback(ctx: ContextTypes.DEFAULT_TYPE, chat:
             # 1) Try Bot API first (fast path)
             for mid in mids:
                 try:
-                    await ctx.bot.delete_message(chat_id=_chatid(chat), message_id=mid)
+                    await _bot_call(ctx.bot, "delete_message", chat, message_id=mid)
                     deleted_any = True
                 except Exception as e:
                     # Keep Bot API error for visibility; collect for Telethon fallback
@@ -267,7 +1117,7 @@ async def _delete_matching_album_fallback(ctx: ContextTypes.DEFAULT_TYPE, chat:
             if bot_failed:
                 try:
                     tgt = await _get_entity_resolving_channels(chat)  # already resolved above; reuse if you kept it
-                    await history_client.delete_messages(tgt, bot_failed, revoke=True)
+                    await _api("tl_delete_messages", chat, history_client.delete_messages(tgt, bot_failed, revoke=True))
                     deleted_any = True
                     logger.info(f"Telethon delete OK in {chat}: {bot_failed}")
                 except Exception as e:
@@ -317,9 +1167,81 @@ async def _get_entity_resolving_channels(chat: str | int):
 
 # ─── /targets: show currently registered forwarding targets ────────
 async def targets(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if not target_chats:
+    all_targets = _all_targets()
+    if not all_targets:
         return await update.message.reply_text("Targets: (none)")
-    await update.message.reply_text("Targets:\n" + "\n".join(map(str, target_chats)))
+    lines = []
+    for c, route in all_targets:
+        line = str(c)
+        if route is not default_route:
+            line += f"  (route {route['source']})"
+        if len(bot_pool) >= 2:
+            line += f"  via @{_bot_for(c, ctx.bot).username}"
+        tc = _target(c)
+        if tc.sender != "bot":
+            line += f"  [{tc.sender}]"
+        if tc.priority:
+            line += f"  priority {tc.priority}"
+        b = tc.breaker
+        if b is not None:
+            line += (f"  ⛔ {b.state.replace('_', '-')} ({b.reason}, {b.skipped} skipped, "
+                     f"probe in {max(0, b.retry_at - time.time()):.0f}s)")
+        lines.append(line)
+    await update.message.reply_text("Targets:\n" + "\n".join(lines))
+
+# ─── /routes, /route, /unroute: manage extra sources ────────
+async def routes(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    lines = ["Routes:"]
+    by_route = {id(r): sid for sid, r in _routes.items()}
+    for route in [default_route, *routes_cfg.values()]:
+        sid = by_route.get(id(route), "unresolved")
+        tag = " (default)" if route is default_route else ""
+        lines.append(f"{route['source']} [{sid}]{tag} → {len(route['targets'])} target(s)")
+        for chat in route["targets"]:
+            over = []
+            if route is not default_route and chat in route["inc_pound"]:
+                over.append(f"pound +{route['inc_pound'][chat]}")
+            if route is not default_route and chat in route["inc_cart"]:
+                over.append(f"cart +{route['inc_cart'][chat]}")
+            lines.append(f"  {chat}" + (f"  ({', '.join(over)})" if over else ""))
+    await update.message.reply_text("\n".join(lines))
+
+async def route(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if len(ctx.args) not in (2, 4):
+        return await update.message.reply_text("Usage: /route <source> <target> [pound_inc cart_inc]")
+    source, chat = str(_chatid(ctx.args[0])), _chatid(ctx.args[1])
+    if source == str(SOURCE_CHAT_ID):
+        return await update.message.reply_text("That is the default source; use /register for its targets.")
+    r = routes_cfg.setdefault(source, _make_route(source, {}))
+    if chat not in r["targets"]:
+        r["targets"].append(chat)
+        _target(chat)
+    if len(ctx.args) == 4:
+        try:
+            r["inc_pound"][chat], r["inc_cart"][chat] = float(ctx.args[2]), float(ctx.args[3])
+        except ValueError:
+            return await update.message.reply_text("Please provide valid numbers.")
+    _save_config()
+    await resolve_routes(ctx.bot)
+    await _assign_target(chat)
+    await update.message.reply_text(f"✅ {source} → {chat}")
+
+async def unroute(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if len(ctx.args) not in (1, 2):
+        return await update.message.reply_text("Usage: /unroute <source> [target]")
+    source = str(_chatid(ctx.args[0]))
+    if source not in routes_cfg:
+        return await update.message.reply_text("No such route. See /routes.")
+    if len(ctx.args) == 2:
+        r, chat = routes_cfg[source], _chatid(ctx.args[1])
+        r["targets"][:] = [c for c in r["targets"] if c != chat]
+        r["inc_pound"].pop(chat, None)
+        r["inc_cart"].pop(chat, None)
+    else:
+        routes_cfg.pop(source)
+    _save_config()
+    _rebuild_routes({r["source"]: sid for sid, r in _routes.items()})
+    await update.message.reply_text(f"✅ Route updated for {source}")
 
 # ─── /register handler ─────────────────────────────
 async def register(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -328,13 +1250,9 @@ async def register(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat = _chatid(ctx.args[0])
     if chat not in target_chats:
         target_chats.append(chat)
-        inc_pound[chat] = THRESHOLD
-        inc_cart[chat] = 15
-        _config["target_chats"] = target_chats
-        _config["inc_pound"] = inc_pound
-        _config["inc_cart"] = inc_cart
-        with open(CONFIG_FILE, "w") as f:
-            json.dump(_config, f, indent=2)
+        _target(chat)
+        _save_config()
+        await _assign_target(chat)
     await update.message.reply_text(f"✅ Added target channel: {chat}")
 
 # ─── /increasepound handler ────────────────────────
@@ -351,10 +1269,8 @@ async def increasepound(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         amt = float(val)
     except ValueError:
         return await update.message.reply_text("Please provide a valid number.")
-    inc_pound[chat] = amt
-    _config["inc_pound"] = inc_pound
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(_config, f, indent=2)
+    _target(chat).inc_pound = amt
+    _save_config()
     await update.message.reply_text(f"✅ Pound increment for {chat} set to +{amt}")
 
 # ─── /increasecart handler ─────────────────────────
@@ -371,27 +1287,59 @@ async def increasecart(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         amt = float(val)
     except ValueError:
         return await update.message.reply_text("Please provide a valid number.")
-    inc_cart[chat] = amt
-    _config["inc_cart"] = inc_cart
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(_config, f, indent=2)
+    _target(chat).inc_cart = amt
+    _save_config()
     await update.message.reply_text(f"✅ Cart increment for {chat} set to +{amt}")
 
 from datetime import datetime
 
-async def prunetargets(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+# ─── Target health checks (cached; refreshed by a background monitor) ────
+HEALTH_CONCURRENCY = int(os.getenv("HEALTH_CONCURRENCY", "8"))
+HEALTH_TTL = float(os.getenv("HEALTH_TTL", "900"))            # seconds a cached check stays fresh
+HEALTH_INTERVAL = float(os.getenv("HEALTH_INTERVAL", "600"))  # background monitor period
+_health = {}  # target chat -> (checked_at, [reasons]); no reasons = ok
+_health_task = None
+
+async def _check_target(bot, chat, tele_ok: bool) -> list[str]:
+    """Reasons `chat` looks unusable, from the owning bot's member record and Telethon visibility."""
+    reason = []
+    # 1) Bot-side checks (admin/delete ability / presence); does not send any messages
+    try:
+        owner = _bot_for(chat, bot)
+        status, can_del = await _bot_admin_status(owner, chat, owner.id)
+        if status not in ("administrator", "creator"):
+            reason.append(f"bot_status={status}")
+        elif not can_del:
+            reason.append("bot_no_delete")
+    except Exception as e:
+        hr = _hard_reason(e) or f"bot_error={type(e).__name__}"
+        reason.append(hr)
+
+    # 2) Telethon visibility (only if Telethon is authorized)
+    if tele_ok:
+        try:
+            ent = await _mt_entity(chat)
+            # Quick visibility probe (cheap): try to iterate 1 message
+            got_one = False
+            async for _m in history_client.iter_messages(ent, limit=1):
+                got_one = True
+                break
+            if not got_one:
+                reason.append("telethon_no_history")
+        except Exception as e:
+            reason.append("telethon_invisible")
+    return reason
+
+async def refresh_health(bot, force: bool = False, ahead: float = 0.0) -> int:
     """
-    Scan all registered targets and prune ones that are clearly unusable:
-      - Bot kicked / restricted / no delete rights (hard errors)
-      - Telethon user cannot resolve (not a member / private)
-    Usage:
-      /prunetargets          -> dry run (reports only)
-      /prunetargets apply    -> actually remove bad targets and save config
+    Re-check every target whose cached result is missing, stale or goes stale within
+    `ahead` seconds (all with force); returns the count.
     """
-    apply = (len(ctx.args) >= 1 and ctx.args[0].lower() == "apply")
-    removed = []
-    report = []
-    keep = []
+    now = time.time()
+    stale = [chat for chat, _ in _all_targets()
+             if force or now + ahead - _health.get(chat, (0.0, None))[0] > HEALTH_TTL]
+    if not stale:
+        return 0
 
     # Ensure Telethon is ready for visibility checks
     tele_ok = True
@@ -402,72 +1350,84 @@ async def prunetargets(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             tele_ok = False
     except Exception as e:
         tele_ok = False
-        logger.exception(f"Telethon connect error in prunetargets: {e}")
+        logger.exception(f"Telethon connect error in health check: {e}")
 
-    # We’ll check bot perms by trying to fetch the bot's member record
-    # (Does not send any messages)
-    bot_id = None
-    try:
-        me = await ctx.bot.get_me()
-        bot_id = me.id
-    except Exception as e:
-        logger.exception(f"get_me failed: {e}")
+    slots = asyncio.Semaphore(HEALTH_CONCURRENCY)
 
-    # Work on a copy so we can safely mutate lists/dicts if apply=True
-    for chat in list(target_chats):
-        reason = []
-        # 1) Bot-side checks (admin/delete ability / presence)
+    async def check(chat):
+        async with slots:
+            _health[chat] = (time.time(), await _check_target(bot, chat, tele_ok))
+
+    await asyncio.gather(*(check(chat) for chat in stale))
+    return len(stale)
+
+async def _health_monitor(bot):
+    # first pass right away; after that each pass also takes the entries that would
+    # expire before the next one, so the cache never serves a stale window
+    while True:
         try:
-            if bot_id is not None:
-                cm = await ctx.bot.get_chat_member(_chatid(chat), bot_id)
-                status = getattr(cm, "status", None)
-                # PTB v20+: ChatMemberAdministrator(.privileges.can_delete_messages)
-                can_del = getattr(getattr(cm, "privileges", None), "can_delete_messages", None)
-                # PTB v13 style fallback:
-                if can_del is None:
-                    can_del = getattr(cm, "can_delete_messages", None)
-                if status not in ("administrator", "creator"):
-                    reason.append(f"bot_status={status}")
-                elif not bool(can_del):
-                    reason.append("bot_no_delete")
+            n = await refresh_health(bot, ahead=HEALTH_INTERVAL)
+            if n:
+                bad = sum(1 for _, r in _health.values() if r)
+                logger.info(f"Health monitor: re-checked {n} target(s), {bad} with problems")
         except Exception as e:
-            hr = _hard_reason(e) or f"bot_error={type(e).__name__}"
-            reason.append(hr)
+            logger.exception(f"Health monitor failed: {e}")
+        await asyncio.sleep(HEALTH_INTERVAL)
 
-        # 2) Telethon visibility (only if Telethon is authorized)
-        if tele_ok:
-            try:
-                ent = await _get_entity_resolving_channels(chat)
-                # Quick visibility probe (cheap): try to iterate 1 message
-                got_one = False
-                async for _m in history_client.iter_messages(ent, limit=1):
-                    got_one = True
-                    break
-                if not got_one:
-                    reason.append("telethon_no_history")
-            except Exception as e:
-                reason.append("telethon_invisible")
+def start_health_monitor(bot):
+    global _health_task
+    _health_task = asyncio.get_running_loop().create_task(_health_monitor(bot))
+
+def stop_health_monitor():
+    if _health_task is not None:
+        _health_task.cancel()
+
+async def prunetargets(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """
+    Report, and optionally prune, targets that are clearly unusable:
+      - Bot kicked / restricted / no delete rights (hard errors)
+      - Telethon user cannot resolve (not a member / private)
+    Answers from the health cache; only entries older than HEALTH_TTL are re-checked.
+    Usage:
+      /prunetargets                -> dry run (reports only)
+      /prunetargets apply          -> actually remove bad targets and save config
+      /prunetargets [apply] fresh  -> re-check every target first
+    """
+    args = [a.lower() for a in ctx.args]
+    apply = "apply" in args
+    removed = []
+    report = []
+    keep = []
+
+    rechecked = await refresh_health(ctx.bot, force="fresh" in args)
+
+    now = time.time()
+    for chat, _route in _all_targets():
+        checked_at, reason = _health.get(chat, (now, []))
+        age = f"{(now - checked_at) / 60:.0f}m ago"
 
         # Decide keep/prune:
         if any(r in ("bot_kicked", "bot_invisible") for r in reason) \
            or ("bot_no_delete" in reason and "telethon_invisible" in reason):
             # definitely unusable
             if apply:
-                # remove from target_chats
+                # remove from target_chats and every route
                 target_chats[:] = [c for c in target_chats if c != chat]
-                # drop per-chat configs if present
-                inc_pound.pop(chat, None)
-                inc_cart.pop(chat, None)
-                album_index.pop(str(chat), None)
-                _save_config()
-                removed.append(f"{chat}  [{', '.join(reason)}]")
-            else:
-                removed.append(f"{chat}  [{', '.join(reason)}]")
+                for r in routes_cfg.values():
+                    r["targets"][:] = [c for c in r["targets"] if c != chat]
+                    r["inc_pound"].pop(chat, None)
+                    r["inc_cart"].pop(chat, None)
+                # drop the target's settings, album index and breaker
+                targets_cfg.pop(chat, None)
+                _health.pop(chat, None)
+            removed.append(f"{chat}  [{', '.join(reason)}]  ({age})")
         else:
-            keep.append(f"{chat}  [{', '.join(reason) if reason else 'ok'}]")
+            keep.append(f"{chat}  [{', '.join(reason) if reason else 'ok'}]  ({age})")
+    if apply and removed:
+        _save_config()
 
     ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-    header = f"🧹 Prune report @ {ts}\nMode: {'APPLY' if apply else 'DRY-RUN'}"
+    header = f"🧹 Prune report @ {ts}\nMode: {'APPLY' if apply else 'DRY-RUN'} · re-checked {rechecked}"
     lines = [header, "", "Will remove:" if not apply else "Removed:"]
     lines += (removed or ["(none)"])
     lines += ["", "Kept:"]
@@ -476,7 +1436,8 @@ async def prunetargets(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 # ─── /post: EXACT text to all registered targets; block hyperlinks; delete-on-sold-out ───
 async def post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if not target_chats:
+    all_targets = _all_targets()
+    if not all_targets:
         return await update.message.reply_text("No targets registered. Use /register <chat> first.")
 
     # text from args or from a replied message
@@ -496,7 +1457,7 @@ async def post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     phrase = _extract_phrase_before_sold_out(text)
     deleted_in = []
     if phrase:
-        for chat in target_chats:
+        for chat, _route in all_targets:
             try:
                 ok = await _delete_matching_album(ctx, chat, phrase)
                 if not ok:
@@ -508,9 +1469,9 @@ async def post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     # broadcast text to all targets
     ok, fail = 0, 0
-    for chat in target_chats:
+    for chat, _route in all_targets:
         try:
-            await ctx.bot.send_message(chat_id=_chatid(chat), text=text)
+            await _bot_call(ctx.bot, "send_message", chat, text=text)
             ok += 1
         except Exception as e:
             fail += 1
@@ -521,7 +1482,8 @@ async def post(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 # ─── /postadj: adjusted text to all registered targets; same delete logic (links allowed) ───
 async def postadj(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if not target_chats:
+    all_targets = _all_targets()
+    if not all_targets:
         return await update.message.reply_text("No targets registered. Use /register <chat> first.")
 
     base = " ".join(ctx.args).strip() if ctx.args else (
@@ -535,7 +1497,7 @@ async def postadj(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     phrase = _extract_phrase_before_sold_out(base)
     deleted_in = []
     if phrase:
-        for chat in target_chats:
+        for chat, _route in all_targets:
             try:
                 ok = await _delete_matching_album(ctx, chat, phrase)
                 if not ok:
@@ -546,9 +1508,9 @@ async def postadj(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 logger.exception(f"Album delete attempt failed for {chat}: {e}")
 
     ok, fail = 0, 0
-    for chat in target_chats:
+    for chat, route in all_targets:
         try:
-            await ctx.bot.send_message(chat_id=_chatid(chat), text=adjust_caption(base, chat))
+            await _bot_call(ctx.bot, "send_message", chat, text=adjust_caption(base, chat, route))
             ok += 1
         except Exception as e:
             fail += 1
@@ -564,6 +1526,76 @@ if not SESSION_STRING:
     raise RuntimeError("SESSION_STRING not set in .env. Please generate a Telethon string session.")
 history_client = TelegramClient(StringSession(SESSION_STRING), API_ID, API_HASH)
 
+# ─── MTProto sender backend (/sender <target> mtproto) ─────────
+# Albums for these targets are re-sent by history_client using the source messages'
+# own media references: nothing is downloaded or uploaded and Bot API size limits
+# don't apply. The Telethon user must be allowed to post in the target.
+SENDERS = ("bot", "mtproto")
+_mt_entities = {}                # chat -> resolved Telethon entity
+_mt_source_msgs = OrderedDict()  # (source chat id, message ids) -> Task fetching the Telethon messages
+
+def _sender_of(chat) -> str:
+    tc = targets_cfg.get(chat)
+    return tc.sender if tc is not None else "bot"
+
+async def _mt_entity(chat):
+    ent = _mt_entities.get(chat)
+    if ent is None:
+        ent = _mt_entities[chat] = await _get_entity_resolving_channels(chat)
+    return ent
+
+async def _mt_source_messages(msgs) -> list:
+    """Telethon messages behind a live album; fetched once per album, shared by all targets."""
+    if all(isinstance(m, _MTPost) for m in msgs):
+        return [m.raw for m in msgs]
+    key = (msgs[0].chat.id, tuple(m.message_id for m in msgs))
+    task = _mt_source_msgs.get(key)
+    if task is None:
+        async def fetch():
+            return await history_client.get_messages(await _mt_entity(key[0]), ids=list(key[1]))
+        task = _mt_source_msgs[key] = asyncio.ensure_future(fetch())
+        if len(_mt_source_msgs) > 64:
+            _mt_source_msgs.popitem(last=False)
+    return [m for m in await task if m is not None]
+
+async def _mt_send_album(chat, src_msgs: list, caption: str | None) -> list:
+    """Send `src_msgs`' media to `chat` as one album, `caption` on the first item."""
+    entity = await _mt_entity(chat)
+    captions = [(caption or "") if i == 0 else "" for i in range(len(src_msgs))]
+    sent = await _api("tl_send_file", chat, history_client.send_file(
+        entity, [m.media for m in src_msgs], caption=captions, parse_mode=None))
+    sent = sent if isinstance(sent, list) else [sent]
+    return [MessageId(m.id) for m in sent]
+
+# ─── /sender: pick the delivery backend of a target ────────
+async def sender(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if len(ctx.args) != 2 or ctx.args[1] not in SENDERS:
+        return await update.message.reply_text("Usage: /sender <chat> bot|mtproto")
+    chat = _chatid(ctx.args[0])
+    if chat not in {c for c, _ in _all_targets()}:
+        return await update.message.reply_text(
+            "Channel not registered. Use the exact id/username shown in /targets."
+        )
+    _target(chat).sender = ctx.args[1]
+    _save_config()
+    await update.message.reply_text(f"✅ Albums for {chat} now go out via {ctx.args[1]}")
+
+# ─── /priority: order of targets within each fan-out ────────
+async def priority(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if len(ctx.args) != 2:
+        return await update.message.reply_text("Usage: /priority <chat> <n>  (higher is served first, default 0)")
+    chat = _chatid(ctx.args[0])
+    if chat not in {c for c, _ in _all_targets()}:
+        return await update.message.reply_text(
+            "Channel not registered. Use the exact id/username shown in /targets."
+        )
+    try:
+        _target(chat).priority = int(ctx.args[1])
+    except ValueError:
+        return await update.message.reply_text("Please provide a whole number.")
+    _save_config()
+    await update.message.reply_text(f"✅ Priority for {chat} set to {ctx.args[1]}")
+
 # ─── /forward handler (history) ─────────────────────────────────
 import tempfile
 
@@ -573,14 +1605,23 @@ async def forward_history(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     grouping albums/media-groups correctly, applying per-channel pound/cart increments.
     """
     # Validate arguments
-    if len(ctx.args) != 1:
-        return await update.message.reply_text("Usage: /forward <chat_id_or_username>")
+    if len(ctx.args) not in (1, 2):
+        return await update.message.reply_text("Usage: /forward <chat_id_or_username> [source]")
     chat = _chatid(ctx.args[0])
-    if chat not in target_chats:
-        return await update.message.reply_text("Channel not registered. Use /register first.")
+    source, route = SOURCE_CHAT, default_route
+    if len(ctx.args) == 2:
+        source = str(_chatid(ctx.args[1]))  # the form /route stores
+        if source in routes_cfg:
+            route = routes_cfg[source]
+        elif _chatid(source) in _routes:  # the default source, or the id of an @username route
+            route = _routes[_chatid(source)]
+        elif source != str(SOURCE_CHAT_ID):
+            return await update.message.reply_text("Not a configured source. See /routes, or add it with /route first.")
+    if chat not in route["targets"]:
+        return await update.message.reply_text("Channel not registered for that source. Use /register or /route first.")
 
     notify = await update.message.reply_text("🔄 Forwarding history… please wait")
-    count = 0
+    count = skipped = 0
 
     # Ensure history_client is ready
     try:
@@ -593,7 +1634,8 @@ async def forward_history(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     # Fetch source channel entity (robust resolver)
     try:
-        src = await _get_entity_resolving_channels(SOURCE_CHAT)
+        src = await _get_entity_resolving_channels(source)
+        src_id = get_peer_id(src)
     except Exception:
         return await notify.edit_text("❌ Cannot access source channel: Telethon user cannot resolve it.")
 
@@ -609,73 +1651,389 @@ async def forward_history(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         key = msg.grouped_id or msg.id
         groups.setdefault(key, []).append(msg)
 
-    # Forward each group
-    temp_dir = tempfile.mkdtemp(prefix="history_")
-    for key, group in groups.items():
-        group.sort(key=lambda m: m.date)
-        if len(group) > 1 and group[0].grouped_id:
-            # Album: download all items and send as a media_group
-            orig_cap = _first_non_empty_caption(group) or ''
-            new_cap = adjust_caption(orig_cap, chat) if orig_cap else None
-            media = []
-            for idx, m in enumerate(group):
-                # Download media into temp_dir, returns the file path
-                path = await history_client.download_media(m, file=temp_dir)
-                cap = new_cap if idx == 0 else None
-                # Determine media type by file extension
-                lower = path.lower()
-                if lower.endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                    media.append(InputMediaPhoto(open(path, 'rb'), caption=cap))
-                elif lower.endswith(('.mp4', '.mov', '.avi', '.mkv')):
-                    media.append(InputMediaVideo(open(path, 'rb'), caption=cap))
-                else:
-                    media.append(InputMediaDocument(open(path, 'rb'), caption=cap))
+    # Forward each group; the temp dir goes away even if this is cancelled at shutdown
+    temp_dir = tempfile.mkdtemp(prefix="history_", dir=HISTORY_TMP_DIR)
+    try:
+        for key, group in groups.items():
+            group.sort(key=lambda m: m.date)
+            lk = _ledger_key(chat, src_id, group[0].id, group[0].grouped_id)
+            if not ledger.claim(lk):
+                skipped += 1  # already delivered there, e.g. by an earlier /forward
+                continue
             try:
-                sent = await ctx.bot.send_media_group(chat_id=_chatid(chat), media=media)
-                count += len(sent)
-                msg_ids = [m.message_id for m in sent]
-                _add_album_record(chat, new_cap or "", msg_ids)
-            except Exception as e:
-                logger.exception(f"/forward_history album send failed for {chat}: {e}")
+                if len(group) > 1 and group[0].grouped_id:
+                    # Album: download all items and send as a media_group
+                    orig_cap = _first_non_empty_caption(group) or ''
+                    new_cap = adjust_caption(orig_cap, chat, route) if orig_cap else None
+                    if _sender_of(chat) == "mtproto":
+                        # re-send by media reference: no download, no upload
+                        try:
+                            sent = await _mt_send_album(chat, group, new_cap)
+                            count += len(sent)
+                            ledger.done(lk, [m.message_id for m in sent], text=new_cap or "")
+                            _add_album_record(chat, new_cap or "", [m.message_id for m in sent])
+                        except Exception as e:
+                            _ledger_failed(lk, e)
+                            logger.exception(f"/forward_history MTProto album send failed for {chat}: {e}")
+                        continue
+                    with contextlib.ExitStack() as files:
+                        media = []
+                        for idx, m in enumerate(group):
+                            # Download media into temp_dir, returns the file path
+                            path = await history_client.download_media(m, file=temp_dir)
+                            cap = new_cap if idx == 0 else None
+                            # local mode: the server reads the file itself (InputMedia turns a Path into file://)
+                            file = Path(path).resolve() if BOT_API_LOCAL else files.enter_context(open(path, 'rb'))
+                            # Determine media type by file extension
+                            lower = path.lower()
+                            if lower.endswith(('.jpg', '.jpeg', '.png', '.gif')):
+                                media.append(InputMediaPhoto(file, caption=cap))
+                            elif lower.endswith(('.mp4', '.mov', '.avi', '.mkv')):
+                                media.append(InputMediaVideo(file, caption=cap, supports_streaming=True))
+                            else:
+                                media.append(InputMediaDocument(file, caption=cap))
+                        try:
+                            sent = await _bot_call(ctx.bot, "send_media_group", chat, media=media)
+                            count += len(sent)
+                            msg_ids = [m.message_id for m in sent]
+                            ledger.done(lk, msg_ids, text=new_cap or "")
+                            _add_album_record(chat, new_cap or "", msg_ids)
+                        except Exception as e:
+                            _ledger_failed(lk, e)
+                            logger.exception(f"/forward_history album send failed for {chat}: {e}")
 
-        else:
-            # Single media message: native forward
-            m = group[0]
+                else:
+                    # Single media message: native forward
+                    m = group[0]
+                    sent = None
+                    try:
+                        sent = await _bot_call(ctx.bot, "copy_message", chat, from_chat_id=src_id, message_id=m.id)
+                        orig_cap = m.caption or m.message or ''
+                        ledger.done(lk, [sent.message_id], text=orig_cap)
+                        new_cap = adjust_caption(orig_cap, chat, route) if orig_cap else None
+                        if new_cap and new_cap != orig_cap:
+                            await _bot_call(ctx.bot, "edit_message_caption", chat, message_id=sent.message_id, caption=new_cap)
+                            ledger.set_text(lk, new_cap)
+                        count += 1
+                    except Exception as e:
+                        if sent is None:  # a failed caption edit doesn't undo the copy
+                            _ledger_failed(lk, e)
+                        logger.exception(f"/forward_history single send failed for {chat}: {e}")
+            finally:
+                ledger.release(lk)  # no-op once done() recorded it
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    # One final status message
+    await notify.edit_text(f"✅ History forwarded: {count} media items to {chat}"
+                           + (f" ({skipped} post(s) already there, skipped)." if skipped else "."))
+    
+# ─── Delivery ledger ────────────────────────────────
+# Which source post already went to which target, keyed (target, source chat, post),
+# with the target message holding its caption/text and the text rendered there (for
+# edit propagation). The post key is str(message id), or "g" + media_group_id
+# (Telethon's grouped_id is the same number). Every sender claims its key first and
+# skips the send if the ledger has it. This covers getUpdates redelivery after a
+# crash, catch-up and a re-run of /forward. Fan-out workers don't read it: the
+# primary claims before queueing a job, and a worker never retries a job (see
+# "Fan-out worker processes"). Recent keys are answered from an LRU. Older ones
+# take one primary-key lookup in LEDGER_DB. Rows expire after LEDGER_DAYS.
+# A send that timed out is recorded as delivered: it may well have gone through, and
+# a missing post is easier to notice and fix than a doubled one.
+LEDGER_DB = os.getenv("LEDGER_DB", "ledger.sqlite")  # ":memory:" keeps it per process
+LEDGER_DAYS = float(os.getenv("LEDGER_DAYS", "30"))
+LEDGER_CACHE = int(os.getenv("LEDGER_CACHE", "50000"))  # keys kept in memory
+
+class DeliveryLedger:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS delivered (
+                target TEXT NOT NULL, source INTEGER NOT NULL, post TEXT NOT NULL,
+                message_ids TEXT, at REAL NOT NULL, edit_id INTEGER, text TEXT,
+                PRIMARY KEY (target, source, post)) WITHOUT ROWID
+        """)
+        cols = {row[1] for row in self.db.execute("PRAGMA table_info(delivered)")}
+        for col, kind in (("edit_id", "INTEGER"), ("text", "TEXT")):  # ledgers from before edit propagation
+            if col not in cols:
+                self.db.execute(f"ALTER TABLE delivered ADD COLUMN {col} {kind}")
+        self.db.execute("DELETE FROM delivered WHERE at < ?", (time.time() - LEDGER_DAYS * 86400,))
+        self._recent = OrderedDict()  # key -> True, most recent last
+        self._claimed = set()         # keys with a send in progress
+
+    def claim(self, key: tuple) -> bool:
+        """True if `key` is neither delivered nor being sent; the caller must then done()/release()."""
+        if key in self._claimed or key in self._recent:
+            return False
+        if self.db.execute("SELECT 1 FROM delivered WHERE target = ? AND source = ? AND post = ?",
+                           key).fetchone():
+            self._remember(key)
+            return False
+        self._claimed.add(key)
+        return True
+
+    def done(self, key: tuple, message_ids: list | None, edit_id: int | None = None, text: str | None = None):
+        """Record `key` as delivered; `edit_id` is the target message carrying `text` (the rendered caption/text)."""
+        if edit_id is None and message_ids:
+            edit_id = message_ids[0]
+        self.db.execute(
+            "INSERT OR REPLACE INTO delivered (target, source, post, message_ids, at, edit_id, text) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (*key, None if message_ids is None else json.dumps(message_ids), time.time(), edit_id, text))
+        self._claimed.discard(key)
+        self._remember(key)
+
+    def sent(self, key: tuple) -> tuple | None:
+        """(target message id holding the caption/text, text rendered there) of a delivered key."""
+        return self.db.execute("SELECT edit_id, text FROM delivered WHERE target = ? AND source = ? AND post = ?",
+                               key).fetchone()
+
+    def set_text(self, key: tuple, text: str):
+        self.db.execute("UPDATE delivered SET text = ? WHERE target = ? AND source = ? AND post = ?", (text, *key))
+
+    def release(self, key: tuple):
+        self._claimed.discard(key)
+
+    def _remember(self, key: tuple):
+        self._recent[key] = True
+        if len(self._recent) > LEDGER_CACHE:
+            self._recent.popitem(last=False)
+
+ledger = DeliveryLedger(LEDGER_DB)
+
+def _ledger_key(chat, source, msg_id, group_id=None) -> tuple:
+    return (str(_chatid(chat)), int(source), f"g{group_id}" if group_id else str(msg_id))
+
+def _ledger_failed(key: tuple, e: Exception):
+    if isinstance(e, TimedOut) or str(e).startswith("TimedOut:"):  # the latter from a fan-out worker
+        ledger.done(key, None)  # outcome unknown; never risk a second copy
+    else:
+        ledger.release(key)
+
+# ─── Ordered delivery lanes ─────────────────────────
+# Every target has its own FIFO lane: jobs for one target run strictly in the
+# order they were submitted (= source order), different targets run in parallel.
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "8"))
+_send_slots = asyncio.Semaphore(SEND_CONCURRENCY)
+_lanes = {}  # target chat -> asyncio.Task at the tail of that target's lane
+_lane_tasks = set()  # every queued or running job, for the shutdown drain
+
+def _enqueue(chat, job, ready: asyncio.Future | None = None):
+    """
+    Append `job` (a no-arg coroutine function) to the lane of `chat`; with `ready`
+    (an album's flush future) the job takes its send slot only once that is done.
+    Must be called without awaiting in between submissions so order is kept.
+    """
+    prev = _lanes.get(chat)
+
+    async def run():
+        if prev is not None:
+            await asyncio.wait([prev])  # prev's own errors are logged by prev
+        if ready is not None:
+            await asyncio.wait([ready])
+        # with fan-out workers the API calls happen in other processes; don't cap lanes here
+        async with (_send_slots if fanout_queue is None else contextlib.nullcontext()):
             try:
-                sent = await ctx.bot.copy_message(chat_id=_chatid(chat), from_chat_id=SOURCE_CHAT_ID, message_id=m.id)
-                orig_cap = m.caption or m.message or ''
-                new_cap = adjust_caption(orig_cap, chat) if orig_cap else None
-                if new_cap and new_cap != orig_cap:
-                    await ctx.bot.edit_message_caption(chat_id=_chatid(sent.chat_id), message_id=sent.message_id, caption=new_cap)
-                count += 1
+                await job()
             except Exception as e:
-                logger.exception(f"/forward_history single send failed for {chat}: {e}")
+                logger.exception(f"delivery job failed for {chat}: {e}")
 
+    task = asyncio.get_running_loop().create_task(run())
+    _lanes[chat] = task
+    _lane_tasks.add(task)
+    task.add_done_callback(_lane_tasks.discard)
+    task.add_done_callback(lambda t, c=chat: _lanes.pop(c, None) if _lanes.get(c) is t else None)
+    return task
 
-    # Cleanup temporary files
-    try:
-        for f in os.listdir(temp_dir):
-            os.remove(os.path.join(temp_dir, f))
-        os.rmdir(temp_dir)
-    except Exception as e:
-        logger.exception(f"history temp cleanup failed: {e}")
+class _SourceOrderedProcessor(BaseUpdateProcessor):
+    """
+    Processes updates concurrently, except that channel posts from the same
+    source chat are handled one at a time in arrival order. Admin commands and
+    unrelated chats never wait behind a source post.
+    """
+    __slots__ = ("_source_locks",)
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._source_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        if not isinstance(update, Update) or not (update.channel_post or update.edited_channel_post):
+            return await coroutine
+        cid = update.effective_chat.id
+        lock = self._source_locks.setdefault(cid, asyncio.Lock())
+        async with lock:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ─── Delivery tracing ──────────────────────────────
+# One JSON line per source post: when it was posted, when we got it, how long it
+# sat in media_buf, and per target how long it queued, rendered and took at the API.
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+_trace_log = logging.getLogger("forwardbot.trace")
+_trace_log.propagate = False
+_trace_log.setLevel(logging.INFO)
+_trace_handler = RotatingFileHandler(TRACE_FILE, maxBytes=5_000_000, backupCount=3, delay=True)
+_trace_handler.setFormatter(logging.Formatter("%(message)s"))
+_trace_log.addHandler(_trace_handler)
+
+def _trace_start(msg, kind: str, targets) -> dict:
+    now = time.time()
+    tr = {
+        "source_chat": msg.chat.id,
+        "source_msg_ids": [msg.message_id],
+        "media_group_id": msg.media_group_id,
+        "kind": kind,
+        "source_date": msg.date.timestamp() if msg.date else None,
+        "arrived": now,
+        "flushed": None,
+        "targets": {str(c): {"enqueued": now} for c in targets},
+        "_pending": len(targets),
+        "_first_id": msg.message_id,
+    }
+    _post_started(tr)
+    return tr
+
+def _trace_target(tr: dict, chat) -> dict:
+    t = tr["targets"][str(chat)]
+    t["started"] = time.time()
+    return t
+
+def _trace_done(tr: dict, chat, error: Exception | None = None):
+    t = tr["targets"][str(chat)]
+    if "api_start" in t:  # duplicates and empty albums never reach the API: no news about the target
+        _breaker_record(chat, error)
+    t["done"] = time.time()
+    t["ok"] = error is None
+    if error is not None:
+        t["error"] = _hard_reason(error) or type(error).__name__
+    tr["_pending"] -= 1
+    if error is None and not _first_response:
+        _log_first_response()
+    if tr["_pending"] == 0:
+        rec = {k: v for k, v in tr.items() if not k.startswith("_")}
+        _trace_log.info(json.dumps(rec, separators=(",", ":")))
+        _post_finished(tr)
+
+def _read_traces(source_msg_id: int) -> list[dict]:
+    """Return all trace records mentioning `source_msg_id`, oldest file first."""
+    found = []
+    paths = [f"{TRACE_FILE}.{i}" for i in range(_trace_handler.backupCount, 0, -1)] + [TRACE_FILE]
+    for path in paths:
+        try:
+            with open(path) as f:
+                for line in f:
+                    if str(source_msg_id) not in line:
+                        continue
+                    rec = json.loads(line)
+                    if source_msg_id in rec.get("source_msg_ids", []):
+                        found.append(rec)
+        except FileNotFoundError:
+            continue
+    return found
+
+def _fmt_trace(rec: dict) -> str:
+    def sec(x):
+        return f"{x:.2f}s" if x is not None else "?"
+    arrived = rec["arrived"]
+    lines = [f"🔎 Source #{rec['source_msg_ids'][0]} ({rec['kind']}, {len(rec['source_msg_ids'])} item(s))"]
+    if rec.get("source_date"):
+        lines.append(f"posted → arrived: {sec(arrived - rec['source_date'])}")
+    if rec.get("flushed"):
+        lines.append(f"buffered in media_buf: {sec(rec['flushed'] - arrived)}")
+    rows = []
+    for chat, t in rec["targets"].items():
+        if "started" not in t:
+            continue
+        # albums can't start before the buffer flushes; that part is reported above
+        queued = t["started"] - max(t["enqueued"], rec.get("flushed") or 0)
+        api = t["done"] - t["api_start"] if "api_start" in t else None
+        rows.append((t["done"] - arrived, chat, queued, t.get("render", 0.0), api, t.get("ok"), t.get("error")))
+    rows.sort(reverse=True)
+    ok = sum(1 for r in rows if r[5])
+    dup = sum(1 for t in rec["targets"].values() if t.get("duplicate"))
+    lines.append(f"targets: {ok} ok, {len(rows) - ok} failed" + (f" ({dup} already delivered, skipped)" if dup else ""))
+    if rows:
+        lines.append(f"arrived → last target done: {sec(rows[0][0])}")
+        lines.append("slowest targets (total / queued / render / api):")
+        for total, chat, queued, render, api, good, err in rows[:5]:
+            lines.append(f"  {chat}: {sec(total)} / {sec(queued)} / {render * 1000:.1f}ms / {sec(api)}" + ("" if good else f" ✗ {err}"))
+    return "\n".join(lines)
+
+# ─── /trace: per-stage timing of one source post ────
+async def trace(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if len(ctx.args) != 1 or not ctx.args[0].isdigit():
+        return await update.message.reply_text("Usage: /trace <source_msg_id>")
+    recs = await asyncio.to_thread(_read_traces, int(ctx.args[0]))
+    if not recs:
+        return await update.message.reply_text("No trace found for that message (it may have rotated out).")
+    await update.message.reply_text("\n\n".join(_fmt_trace(r) for r in recs[-3:]))
 
-    # One final status message
-    await notify.edit_text(f"✅ History forwarded: {count} media items to {chat}.")
-    
 # buffer for live media-groups
 media_buf = {}
-FLUSH_DELAY = 1.0
+media_ready = {}   # media_group_id -> Future resolved with the album's messages on flush
+media_traces = {}  # media_group_id -> trace record of the album
+media_flush = {}   # media_group_id -> TimerHandle of its pending flush
+_flushed_groups = OrderedDict()  # media_group_ids flushed lately, to report items that came too late
+FLUSH_DELAY = 1.0  # seconds after an album's last item arrived
+
+def _schedule_flush(gid: str, ctx):
+    """(Re)start the album's flush timer: the flush runs FLUSH_DELAY after the latest item."""
+    handle = media_flush.pop(gid, None)
+    if handle is not None:
+        handle.cancel()
+    media_flush[gid] = asyncio.get_running_loop().call_later(
+        FLUSH_DELAY,
+        lambda: asyncio.create_task(flush_media_group(gid, ctx))
+    )
 
 async def flush_media_group(gid: str, ctx: ContextTypes.DEFAULT_TYPE):
+    handle = media_flush.pop(gid, None)
+    if handle is not None:
+        handle.cancel()  # flushed early by the shutdown drain
+    _flushed_groups[gid] = None
+    if len(_flushed_groups) > 1000:
+        _flushed_groups.popitem(last=False)
     msgs = media_buf.pop(gid, [])
-    if not msgs:
-        return
+    fut = media_ready.pop(gid, None)
+    tr = media_traces.pop(gid, None)
     msgs.sort(key=lambda m: m.message_id)
-    orig = _first_non_empty_caption(msgs)
-    for chat in target_chats:
-        try:
-            new_cap = adjust_caption(orig, chat)
+    if tr is not None:
+        tr["flushed"] = time.time()
+        tr["source_msg_ids"] = [m.message_id for m in msgs]
+    if fut is not None and not fut.done():
+        fut.set_result(msgs)
+
+async def _send_album(ctx: ContextTypes.DEFAULT_TYPE, chat, fut: asyncio.Future, tr: dict, route: dict | None = None):
+    msgs = await fut
+    t = _trace_target(tr, chat)
+    err = lk = sent = None
+    cut = False
+    cap_at = 0  # position of the captioned item in the sent album
+    try:
+        if not msgs:
+            return
+        lk = _ledger_key(chat, msgs[0].chat.id, msgs[0].message_id, msgs[0].media_group_id)
+        if not ledger.claim(lk):
+            t["duplicate"] = True
+            DUPLICATES_SKIPPED.labels("album").inc()
+            lk = None
+            return
+        orig = _first_non_empty_caption(msgs)
+        r0 = time.perf_counter()
+        new_cap = adjust_caption(orig, chat, route)
+        if _sender_of(chat) == "mtproto":
+            t["render"] = time.perf_counter() - r0
+            t["api_start"] = time.time()
+            sent = await _mt_send_album(chat, await _mt_source_messages(msgs), new_cap)
+        elif _bot_for(chat, ctx.bot) is ctx.bot and not isinstance(msgs[0], _MTPost):
             media = []
             for idx, m in enumerate(msgs):
                 cap = new_cap if idx == 0 else None
@@ -685,84 +2043,893 @@ async def flush_media_group(gid: str, ctx: ContextTypes.DEFAULT_TYPE):
                     media.append(InputMediaVideo(m.video.file_id, caption=cap))
                 else:
                     media.append(InputMediaDocument(m.document.file_id, caption=cap))
-            sent = await ctx.bot.send_media_group(chat_id=_chatid(chat), media=media)
-            msg_ids = [m.message_id for m in sent]
-            _add_album_record(chat, new_cap or "", msg_ids)
-        except Exception as e:
-            logger.exception(f"flush_media_group failed for {chat}: {e}")
-            continue
+            t["render"] = time.perf_counter() - r0
+            t["api_start"] = time.time()
+            sent = await _deliver(ctx, "send_media_group", chat, media=media)
+        else:
+            # file_ids only work for the bot that received them: pool bots (and posts that
+            # came in over MTProto, which carry no Bot API file_ids) copy from the source
+            t["render"] = time.perf_counter() - r0
+            t["api_start"] = time.time()
+            sent = await _deliver(ctx, "copy_messages", chat,
+                                  from_chat_id=msgs[0].chat.id, message_ids=[m.message_id for m in msgs])
+            cap_idx = next((i for i, m in enumerate(msgs) if (m.caption or "").strip()), None)
+            cap_at = cap_idx or 0
+            if cap_idx is not None and new_cap != msgs[cap_idx].caption:
+                await _deliver(ctx, "edit_message_caption", chat,
+                               message_id=sent[cap_idx].message_id, caption=new_cap)
+        _observe_lag("album", msgs[0].date)
+        msg_ids = [m.message_id for m in sent]
+        ledger.done(lk, msg_ids, msg_ids[cap_at], new_cap or "")
+        _add_album_record(chat, new_cap or "", msg_ids)
+    except asyncio.CancelledError:
+        # cut off by the shutdown drain: left pending, so _record_unsent() puts it in `unsent`
+        cut = True
+        if lk is not None and sent is None:
+            ledger.release(lk)
+        elif lk is not None:
+            ledger.done(lk, [m.message_id for m in sent], sent[cap_at].message_id)
+        raise
+    except Exception as e:
+        err = e
+        if lk is not None and sent is None:
+            _ledger_failed(lk, e)
+        elif lk is not None:  # copied, but the caption edit failed: the album is there
+            ledger.done(lk, [m.message_id for m in sent], sent[cap_at].message_id)
+        _log_send_failure("flush_media_group", chat, e)
+    finally:
+        if not cut:
+            _trace_done(tr, chat, err)
+
+async def _send_copy(ctx: ContextTypes.DEFAULT_TYPE, chat, msg, tr: dict, route: dict | None = None):
+    t = _trace_target(tr, chat)
+    err, cut = None, False
+    orig_caption = msg.caption or ""
+    lk = _ledger_key(chat, msg.chat.id, msg.message_id)
+    if not ledger.claim(lk):
+        t["duplicate"] = True
+        DUPLICATES_SKIPPED.labels("single").inc()
+        return _trace_done(tr, chat)
+    try:
+        # Compute adjusted caption
+        r0 = time.perf_counter()
+        new_cap = adjust_caption(orig_caption, chat, route) if orig_caption else None
+        t["render"] = time.perf_counter() - r0
+        t["api_start"] = time.time()
+        # Copy with overridden caption if applicable
+        sent = await _deliver(ctx, "copy_message", chat,
+            from_chat_id=msg.chat.id,
+            message_id=msg.message_id,
+            caption=new_cap
+        )
+        ledger.done(lk, [sent.message_id] if sent is not None else [], text=new_cap or "")
+        _observe_lag("single", msg.date)
+    except asyncio.CancelledError:
+        cut = True  # cut off by the shutdown drain, see _send_album
+        ledger.release(lk)
+        raise
+    except Exception as e:
+        err = e
+        _ledger_failed(lk, e)
+        _log_send_failure("forward_handler copy_message", chat, e)
+    finally:
+        if not cut:
+            _trace_done(tr, chat, err)
+
+async def _send_text(ctx: ContextTypes.DEFAULT_TYPE, chat, msg, tr: dict, route: dict | None = None):
+    t = _trace_target(tr, chat)
+    err, cut = None, False
+    lk = _ledger_key(chat, msg.chat.id, msg.message_id)
+    if not ledger.claim(lk):
+        t["duplicate"] = True
+        DUPLICATES_SKIPPED.labels("text").inc()
+        return _trace_done(tr, chat)
+    try:
+        r0 = time.perf_counter()
+        new_txt = adjust_caption(msg.text, chat, route)
+        t["render"] = time.perf_counter() - r0
+        t["api_start"] = time.time()
+        sent = await _deliver(ctx, "send_message", chat, text=new_txt)
+        ledger.done(lk, [sent.message_id] if sent is not None else [], text=new_txt)
+        _observe_lag("text", msg.date)
+    except asyncio.CancelledError:
+        cut = True  # cut off by the shutdown drain, see _send_album
+        ledger.release(lk)
+        raise
+    except Exception as e:
+        err = e
+        _ledger_failed(lk, e)
+        _log_send_failure("forward_handler send_message", chat, e)
+    finally:
+        if not cut:
+            _trace_done(tr, chat, err)
+
+def _is_source(update: Update) -> bool:
+    chat = update.effective_chat
+    return chat is not None and chat.id in _routes
+
+# ─── Update recorder (RECORD_UPDATES=path.jsonl) ────
+# Appends every source channel update with its arrival time, for replay.py.
+RECORD_UPDATES = os.getenv("RECORD_UPDATES")
+_record_fh = None
+
+async def record_update(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    global _record_fh
+    if not (update.channel_post or update.edited_channel_post) or not _is_source(update):
+        return
+    try:
+        if _record_fh is None:
+            _record_fh = open(RECORD_UPDATES, "a", buffering=1)
+        _record_fh.write(json.dumps({"t": time.time(), "update": update.to_dict()}, separators=(",", ":")) + "\n")
+    except Exception as e:
+        logger.exception(f"recording update failed: {e}")
+
+# ─── Per-target circuit breaker ─────────────────────
+# A hard error (bot kicked, rights removed, chat gone, Forbidden) opens the target's
+# breaker and live posts skip it instead of failing there one by one. Once the probe
+# interval has passed, the next post goes through as a half-open probe: success closes
+# the breaker, another hard error re-opens it with the interval doubled.
+BREAKER_PROBE_INTERVAL = float(os.getenv("BREAKER_PROBE_INTERVAL", "300"))
+BREAKER_MAX_INTERVAL = 6 * 3600.0
+
+class _Breaker:
+    __slots__ = ("state", "reason", "since", "retry_at", "interval", "skipped")
+
+    def __init__(self):
+        self.state = "closed"
+        self.interval = BREAKER_PROBE_INTERVAL
+        self.since = self.retry_at = 0.0
+        self.reason = ""
+        self.skipped = 0
+
+BREAKERS_OPEN = Gauge("forwardbot_breakers_open", "Targets whose circuit breaker is open or half-open")
+BREAKERS_OPEN.set_function(lambda: sum(1 for tc in targets_cfg.values() if tc.breaker is not None))
+
+def _breaker_reason(e: Exception) -> str:
+    """Reason string if `e` means the target itself is unusable, else ""."""
+    return _hard_reason(e) or ("forbidden" if isinstance(e, Forbidden) else "")
+
+def _admitted(targets) -> list:
+    """
+    The targets whose breaker lets this post through, highest priority first.
+    May turn an open breaker half-open.
+    """
+    out, now, ranked = [], time.time(), False
+    for chat in targets:
+        tc = targets_cfg.get(chat)
+        if tc is not None:
+            b = tc.breaker
+            if b is not None:
+                if now < b.retry_at:
+                    b.skipped += 1
+                    continue
+                b.state = "half_open"
+                b.retry_at = now + b.interval  # probe again later if this one never reports back
+            ranked = ranked or tc.priority != 0
+        out.append(chat)
+    if ranked:
+        out.sort(key=lambda c: -targets_cfg[c].priority if c in targets_cfg else 0)
+    return out
 
-# ─── Live forward handler ───────────────────────────
-async def forward_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    msg = update.effective_message
-    # Only handle messages from the source channel
-    if isinstance(SOURCE_CHAT_ID, int):
-        if update.effective_chat.id != SOURCE_CHAT_ID or not target_chats:
-            return
+def _breaker_record(chat, error: Exception | None):
+    tc = targets_cfg.get(chat)
+    b = tc.breaker if tc is not None else None
+    reason = _breaker_reason(error) if error is not None else ""
+    if reason:
+        if b is None:
+            b = _target(chat).breaker = _Breaker()
+            b.since = time.time()
+            logger.warning(f"Breaker opened for {chat}: {reason}")
+        elif b.state == "half_open":
+            b.interval = min(b.interval * 2, BREAKER_MAX_INTERVAL)
+        b.state, b.reason = "open", reason
+        b.retry_at = time.time() + b.interval
+    elif b is not None and b.state == "half_open":
+        if error is None:
+            logger.info(f"Breaker closed for {chat} after {b.skipped} skipped post(s)")
+            tc.breaker = None
+        else:
+            b.state = "open"  # soft failure: inconclusive, probe again after the interval
+
+def _log_send_failure(what: str, chat, e: Exception):
+    reason = _breaker_reason(e)
+    if reason:
+        logger.warning(f"{what} failed for {chat}: {reason}")  # the breaker handles it; no traceback
     else:
-        # SOURCE_CHAT_ID is like '@name'
-        if (not update.effective_chat.username) or update.effective_chat.username.lower() != str(SOURCE_CHAT_ID).lstrip('@').lower() or not target_chats:
-            return
+        logger.exception(f"{what} failed for {chat}: {e}")
 
-    # Handle media groups
+# ─── Live forward handler ───────────────────────────
+# INGEST picks where source posts come from: "bot" (getUpdates), "mtproto" (Telethon
+# events on history_client) or "both". Either way every post is claimed in _seen_posts
+# first, so when both paths are on the one that delivers it first wins.
+INGEST = os.getenv("INGEST", "bot").lower()
+SEEN_POSTS_MAX = 20_000
+_seen_posts = OrderedDict()  # (source chat id, message id or "g"+media group id) -> None
+
+def _claim_post(key) -> bool:
+    """True the first time `key` is seen; later calls (from either ingestion path) get False."""
+    if key in _seen_posts:
+        return False
+    _seen_posts[key] = None
+    if len(_seen_posts) > SEEN_POSTS_MAX:
+        _seen_posts.popitem(last=False)
+    return True
+
+def _has_media(msg) -> bool:
+    if isinstance(msg, _MTPost):
+        return msg.media
+    return bool(msg.photo or msg.video or msg.document)
+
+def _dispatch(ctx, route: dict, msg):
+    """Enqueue source post `msg` on every target lane of `route`. Must not await."""
+    if not route["targets"]:
+        return
+    targets = list(route["targets"])
+
+    # Nothing below may await before the jobs are enqueued: lane order == source order.
+
+    # Handle media groups: the first item reserves a slot in every lane,
+    # the album is sent there once the buffer is flushed.
     if msg.media_group_id:
-        media_buf.setdefault(msg.media_group_id, []).append(msg)
-        loop = asyncio.get_event_loop()
-        loop.call_later(
-            FLUSH_DELAY,
-            lambda: asyncio.create_task(flush_media_group(msg.media_group_id, ctx))
-        )
+        gid = msg.media_group_id
+        if gid not in media_buf:
+            if not _claim_post((msg.chat.id, "g" + gid)):
+                if gid in _flushed_groups:
+                    logger.warning(f"Album {gid}: item {msg.message_id} arrived more than {FLUSH_DELAY}s "
+                                   f"after the previous one, when the album was already sent; not forwarded")
+                return  # otherwise the MTProto path has the album
+            targets = _admitted(targets)
+            if not targets:
+                return  # later items of the album fail _claim_post too
+            fut = media_ready[gid] = asyncio.get_running_loop().create_future()
+            tr = media_traces[gid] = _trace_start(msg, "album", targets)
+            for chat in targets:
+                _enqueue(chat, lambda c=chat: _send_album(ctx, c, fut, tr, route), fut)
+        media_buf.setdefault(gid, []).append(msg)
+        _schedule_flush(gid, ctx)
         return
 
-            # Handle single media items (photo, video, document)
-    if msg.photo or msg.video or msg.document:
-        orig_caption = msg.caption or ""
-        for chat in target_chats:
-            try:
-                # Compute adjusted caption
-                new_cap = adjust_caption(orig_caption, chat) if orig_caption else None
-                # Copy with overridden caption if applicable
-                await ctx.bot.copy_message(
-                    chat_id=_chatid(chat),
-                    from_chat_id=msg.chat.id,
-                    message_id=msg.message_id,
-                    caption=new_cap
-                )
-            except Exception as e:
-                logger.exception(f"forward_handler copy_message failed for {chat}: {e}")
-                continue
+    if not _claim_post((msg.chat.id, msg.message_id)):
+        return
 
+    # Handle single media items (photo, video, document)
+    if _has_media(msg):
+        targets = _admitted(targets)
+        if not targets:
+            return
+        tr = _trace_start(msg, "single", targets)
+        for chat in targets:
+            _enqueue(chat, lambda c=chat: _send_copy(ctx, c, msg, tr, route))
         return
 
-    # Handle text-only pricing posts (cart or pound) (cart or pound)
+    # Handle text-only pricing posts (cart or pound)
     if msg.text:
         # Only forward if text contains a price slash pattern
         if _pattern.search(msg.text):
-            for chat in target_chats:
-                new_txt = adjust_caption(msg.text, chat)
-                try:
-                    await ctx.bot.send_message(chat_id=_chatid(chat), text=new_txt)
-                except Exception as e:
-                    logger.exception(f"forward_handler send_message failed for {chat}: {e}")
-                    continue
+            targets = _admitted(targets)
+            if not targets:
+                return
+            tr = _trace_start(msg, "text", targets)
+            for chat in targets:
+                _enqueue(chat, lambda c=chat: _send_text(ctx, c, msg, tr, route))
         return
 
+async def forward_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if INGEST == "mtproto":
+        return
+    msg = update.effective_message
+    # Only handle messages from a routed source channel
+    chat = update.effective_chat
+    route = _routes.get(chat.id) if chat is not None else None
+    if route is None:
+        return
+    if update.edited_channel_post is not None:
+        return _dispatch_edit(ctx, route, msg)
+    _dispatch(ctx, route, msg)
+
+# ─── Edit propagation ───────────────────────────────
+# An edited source post is re-rendered per target with adjust_caption and applied
+# with edit_message_caption / edit_message_text to the message the ledger recorded
+# for it, only where the rendered text differs from what that target shows. Edits
+# go through the target lanes: they queue behind the original send if that is still
+# pending, and share the lanes' concurrency cap and the bots' rate limits.
+def _dispatch_edit(ctx, route: dict, msg):
+    """Enqueue the re-render of edited source post `msg` on every target lane of `route`. Must not await."""
+    edited = int(msg.edit_date.timestamp()) if msg.edit_date else 0
+    if not _claim_post((msg.chat.id, f"e{msg.message_id}", edited)):
+        return  # the other ingestion path already has this edit
+    media = _has_media(msg)
+    text = (msg.caption if media else msg.text) or ""
+    if msg.media_group_id and not text.strip():
+        return  # an album item without caption; the caption lives on another item
+    post = f"g{msg.media_group_id}" if msg.media_group_id else str(msg.message_id)
+    for chat in route["targets"]:
+        tc = targets_cfg.get(chat)
+        if tc is not None and tc.breaker is not None:
+            continue  # edits never probe a tripped breaker (they don't report to it); new posts do
+        _enqueue(chat, lambda c=chat: _send_edit(ctx, c, msg, post, text, media, route))
+
+async def _send_edit(ctx, chat, msg, post: str, text: str, media: bool, route: dict):
+    key = (str(_chatid(chat)), int(msg.chat.id), post)
+    row = ledger.sent(key)
+    if row is None or row[0] is None:
+        return  # never delivered there (or before the ledger kept message ids)
+    edit_id, shown = row
+    new = adjust_caption(text, chat, route) if text else ""
+    if new == shown:
+        return
+    method = "edit_message_caption" if media else "edit_message_text"
+    try:
+        if media:
+            await _deliver(ctx, method, chat, message_id=edit_id, caption=new)
+        else:
+            await _deliver(ctx, method, chat, message_id=edit_id, text=new)
+        ledger.set_text(key, new)
+        EDITS_PROPAGATED.labels(method).inc()
+        if msg.media_group_id:
+            _update_album_record(chat, edit_id, new)
+    except Exception as e:
+        _log_send_failure(f"edit propagation {method}", chat, e)
+
+# ─── MTProto ingestion (INGEST=mtproto|both) ────────
+class _MTPost:
+    """The Bot API Message attributes the live senders read, filled from a Telethon message."""
+    __slots__ = ("chat", "message_id", "media_group_id", "date", "edit_date", "text", "caption", "media", "raw")
+
+    def __init__(self, m):
+        self.chat = SimpleNamespace(id=m.chat_id)
+        self.message_id = m.id
+        self.media_group_id = str(m.grouped_id) if m.grouped_id else None  # same value the Bot API reports
+        self.date = m.date
+        self.edit_date = m.edit_date
+        self.media = bool(m.photo or m.document)
+        self.text = None if self.media else m.raw_text
+        self.caption = m.raw_text if self.media else None
+        self.raw = m  # the MTProto sender re-sends m.media as is
+
+_mt_ctx = None  # stands in for the CallbackContext: the senders only use .bot
+
+async def _on_mt_message(event):
+    if event.message.grouped_id:
+        return  # albums arrive whole through events.Album
+    route = _routes.get(event.chat_id)
+    if route is not None:
+        _dispatch(_mt_ctx, route, _MTPost(event.message))
+
+async def _on_mt_edit(event):
+    route = _routes.get(event.chat_id)
+    if route is not None:
+        _dispatch_edit(_mt_ctx, route, _MTPost(event.message))
+
+async def _on_mt_album(event):
+    route = _routes.get(event.chat_id)
+    if route is None or not route["targets"]:
+        return
+    _dispatch_album(_mt_ctx, route, [_MTPost(m) for m in event.messages])
+
+def _dispatch_album(ctx, route: dict, msgs: list):
+    """Enqueue an already complete album (no media_buf flush needed). Must not await."""
+    msgs = sorted(msgs, key=lambda m: m.message_id)
+    first = msgs[0]
+    if not _claim_post((first.chat.id, "g" + first.media_group_id)):
+        return  # the Bot API path already has this album
+    targets = _admitted(route["targets"])
+    if not targets:
+        return
+    fut = asyncio.get_running_loop().create_future()
+    tr = _trace_start(first, "album", targets)
+    tr["flushed"] = time.time()
+    tr["source_msg_ids"] = [m.message_id for m in msgs]
+    fut.set_result(msgs)
+    for chat in targets:
+        _enqueue(chat, lambda c=chat: _send_album(ctx, c, fut, tr, route), fut)
+
+def start_mtproto_ingest(bot):
+    """Listen for source posts on history_client (must be connected already)."""
+    global _mt_ctx
+    if INGEST not in ("mtproto", "both"):
+        return
+    _mt_ctx = SimpleNamespace(bot=bot)
+    is_source = lambda e: e.chat_id in _routes
+    history_client.add_event_handler(_on_mt_message, events.NewMessage(func=is_source))
+    history_client.add_event_handler(_on_mt_album, events.Album(func=is_source))
+    history_client.add_event_handler(_on_mt_edit, events.MessageEdited(func=is_source))
+    logger.info(f"MTProto ingestion on ({INGEST})")
+
+# ─── Catch-up after restart ─────────────────────────
+# high_water[source] only moves past a post once every target lane has finished it,
+# and never past a post that is still in flight. On startup everything newer is read
+# back through Telethon and pushed through _dispatch before live updates are taken.
+CATCHUP_LIMIT = int(os.getenv("CATCHUP_LIMIT", "500"))   # source messages per source, oldest first
+CATCHUP_RATE  = float(os.getenv("CATCHUP_RATE", "2"))    # posts per second
+_inflight = {}       # source chat id -> first message id -> trace of a post still being delivered
+_done_max = {}       # source chat id -> highest source message id delivered so far
+
+def _post_started(tr: dict):
+    _inflight.setdefault(tr["source_chat"], {})[tr["_first_id"]] = tr
+
+def _post_finished(tr: dict):
+    src = tr["source_chat"]
+    pending = _inflight.get(src, {})
+    pending.pop(tr["_first_id"], None)
+    _done_max[src] = max(_done_max.get(src, 0), *tr["source_msg_ids"])
+    mark = min(pending) - 1 if pending else _done_max[src]
+    if mark > high_water.get(str(src), 0):
+        high_water[str(src)] = mark
+        _save_config(BACKGROUND_SAVE_DELAY)
+
+async def catch_up(bot):
+    """Forward source posts newer than the stored high-water mark (history_client must be connected)."""
+    ctx = SimpleNamespace(bot=bot)
+    had_unsent = bool(unsent)
+    for sid, route in list(_routes.items()):
+        last = high_water.get(str(sid))
+        todo = unsent.pop(str(sid), None)
+        if not last or not route["targets"]:
+            continue
+        try:
+            entity = await _mt_entity(sid)
+            missed = [m async for m in history_client.iter_messages(
+                entity, min_id=last, limit=CATCHUP_LIMIT, reverse=True)]
+        except Exception as e:
+            logger.exception(f"Catch-up: reading {sid} after {last} failed: {e}")
+            continue
+        if len(missed) >= CATCHUP_LIMIT:
+            logger.warning(f"Catch-up: {sid} has more than {CATCHUP_LIMIT} missed messages; only the oldest are sent")
+        posts = []
+        for m in missed:
+            if m.grouped_id and posts and posts[-1][0].grouped_id == m.grouped_id:
+                posts[-1].append(m)
+            else:
+                posts.append([m])
+        logger.info(f"Catch-up: {len(posts)} post(s) in {sid} after message {last}")
+        for post in posts:
+            post_route = route
+            if todo is not None:
+                left = next((todo["posts"][str(m.id)] for m in post if str(m.id) in todo["posts"]), None)
+                if left is not None:
+                    # cut off by the last shutdown: only the targets that did not get it
+                    post_route = dict(route, targets=[c for c in map(_chatid, left) if c in route["targets"]])
+                elif post[0].id <= todo["done_max"]:
+                    continue  # delivered everywhere before the last shutdown
+            if post[0].grouped_id:
+                _dispatch_album(ctx, post_route, [_MTPost(m) for m in post])
+            else:
+                _dispatch(ctx, post_route, _MTPost(post[0]))
+            await asyncio.sleep(1 / CATCHUP_RATE)
+    if had_unsent:
+        unsent.clear()
+        _save_config(BACKGROUND_SAVE_DELAY)
+
+# ─── Graceful shutdown ──────────────────────────────
+# SIGTERM/SIGINT start the drain before PTB's Application.stop(), which would wait for
+# every running handler (a long /forward) with no deadline. Polling stops first;
+# updates already fetched are still handled. Ingestion is closed: MTProto handlers
+# are removed and the webhook answers 503, so Telegram retries the update later.
+# Albums still in media_buf are flushed at once. Lanes and the long-running commands
+# (/forward, /post, /postadj, /prunetargets) get SHUTDOWN_DRAIN_TIMEOUT seconds in
+# total, then whatever is left is cancelled. Deliveries still missing are recorded
+# in `unsent`, per source message and target, and catch_up sends exactly those on
+# the next start. Then PTB stops; post_shutdown writes the config.
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+_draining = False
+_drain_task = None
+_stop_task = None       # signal-started drain followed by Application.stop_running()
+_command_tasks = set()  # running long commands, see _cancellable
+
+def _cancellable(handler):
+    """Run command `handler` as a task the shutdown drain can wait for and cancel."""
+    @wraps(handler)
+    async def run(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        if _draining:
+            return await update.message.reply_text("⏳ Shutting down; send it again after the restart.")
+        task = asyncio.ensure_future(handler(update, ctx))
+        _command_tasks.add(task)
+        task.add_done_callback(_command_tasks.discard)
+        return await task
+    return run
+
+def _stop_ingest():
+    global _draining
+    _draining = True
+    history_client.remove_event_handler(_on_mt_message)
+    history_client.remove_event_handler(_on_mt_album)
+    history_client.remove_event_handler(_on_mt_edit)
+
+def _record_unsent() -> int:
+    """Move the deliveries of posts still in flight into `unsent`; returns how many there are."""
+    count = 0
+    for src, pending in _inflight.items():
+        if not pending:
+            continue
+        posts = {}
+        for tr in pending.values():
+            left = [c for c, t in tr["targets"].items() if "done" not in t]
+            count += len(left)
+            for mid in tr["source_msg_ids"]:
+                posts[str(mid)] = left
+        unsent[str(src)] = {"done_max": _done_max.get(src, 0), "posts": posts}
+        high_water.setdefault(str(src), min(pending) - 1)  # so catch_up looks at this source
+    return count
+
+async def drain_deliveries(timeout: float = SHUTDOWN_DRAIN_TIMEOUT) -> int:
+    """
+    Flush media_buf and wait for every lane and long command, cancelling what is
+    left after `timeout`; returns the number of deliveries cut off.
+    """
+    _stop_ingest()
+    for gid in list(media_buf):
+        await flush_media_group(gid, None)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    if _lane_tasks or _command_tasks:
+        logger.info(f"Shutdown: draining {len(_lane_tasks)} delivery job(s) and "
+                    f"{len(_command_tasks)} command(s), up to {timeout:.0f}s")
+    # commands and updates still being handled add lane jobs: wait until none are left
+    while tasks := _lane_tasks | _command_tasks:
+        left = deadline - loop.time()
+        if left > 0:
+            await asyncio.wait(tasks, timeout=left)
+            continue
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+    return _record_unsent()
+
+async def _drain():
+    cut = await drain_deliveries()
+    if cut:
+        logger.warning(f"Shutdown: {cut} delivery(ies) not finished in time; they are sent after the restart")
+    else:
+        logger.info("Shutdown: all deliveries finished")
+
+async def shutdown_drain():
+    """Run the drain once; later calls wait for the same one."""
+    global _drain_task
+    if _drain_task is None:
+        _drain_task = asyncio.ensure_future(_drain())
+    await asyncio.shield(_drain_task)
+
+def _on_stop_signal(application):
+    global _stop_task
+    if not _serving:
+        raise SystemExit  # still starting: nothing to drain yet (what PTB's own handler does)
+    if _stop_task is None:
+        _stop_task = asyncio.ensure_future(_drain_then_stop(application))
+
+async def _drain_then_stop(application):
+    try:
+        if application.updater is not None and application.updater.running:
+            await application.updater.stop()  # no new getUpdates; fetched updates are still handled
+        await shutdown_drain()
+    finally:
+        application.stop_running()  # run_polling goes on with stop(), post_stop, shutdown
+
+async def _post_stop(application):
+    await shutdown_drain()  # already done when the stop came from a signal
+
+
+# ─── Config hot reload (edit config.json, or /reload) ──────
+# The file is polled with os.stat every CONFIG_RELOAD_INTERVAL seconds (0 = only on
+# /reload). A changed file is validated first; an invalid one is logged and the running
+# config is kept. A valid one replaces targets, routes and per-target settings in one
+# synchronous step on the event loop, i.e. between two updates: posts already fanned
+# out finish with the targets they were given, media_buf and Telethon are untouched.
+# high_water, unsent and album_index are owned by the running bot and are not read back.
+# Edits on disk win over command changes that have not been saved yet.
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "2"))
+_reload_bot = None    # bot used to resolve new sources / assign new targets
+_reload_task = None
+
+def _is_number(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+def _validate_config(cfg):
+    """Raise ValueError naming the first problem in a parsed config.json."""
+    if not isinstance(cfg, dict):
+        raise ValueError("top level must be an object")
+    for key in ("target_chats", "text_targets"):
+        v = cfg.get(key, [])
+        if not isinstance(v, list) or not all(isinstance(c, (int, str)) for c in v):
+            raise ValueError(f"{key} must be a list of chat ids")
+    for key in ("targets", "inc_pound", "inc_cart", "target_senders"):  # the last three: older configs
+        if not isinstance(cfg.get(key, {}), dict):
+            raise ValueError(f"{key} must be an object keyed by chat id")
+    for chat, s in _target_settings(cfg).items():
+        if not isinstance(s, dict):
+            raise ValueError(f"settings of target {chat} must be an object")
+        for field in ("inc_pound", "inc_cart"):
+            if field in s and not _is_number(s[field]):
+                raise ValueError(f"{field} of target {chat} must be a number")
+        if s.get("sender", "bot") not in SENDERS:
+            raise ValueError(f"sender of target {chat} must be one of {', '.join(SENDERS)}")
+        if not isinstance(s.get("priority", 0), int) or isinstance(s.get("priority"), bool):
+            raise ValueError(f"priority of target {chat} must be a whole number")
+    routes = cfg.get("routes", {})
+    if not isinstance(routes, dict):
+        raise ValueError("routes must be an object")
+    for src, r in routes.items():
+        if str(_chatid(src)) == str(SOURCE_CHAT_ID):
+            raise ValueError(f"route {src} is the default source")
+        if not isinstance(r, dict) or not isinstance(r.get("targets", []), list):
+            raise ValueError(f"route {src} must be an object with a targets list")
+        if not all(isinstance(c, (int, str)) and not isinstance(c, bool) for c in r.get("targets", [])):
+            raise ValueError(f"targets of route {src} must be chat ids")
+        for field in ("inc_pound", "inc_cart"):
+            over = r.get(field, {})
+            if not isinstance(over, dict) or not all(_is_number(v) for v in over.values()):
+                raise ValueError(f"{field} of route {src} must map targets to numbers")
+
+def _read_config_file():
+    sig = _config_stat()
+    with open(CONFIG_FILE) as f:
+        return sig, f.read()
+
+async def reload_config() -> str:
+    """Load config.json from disk and swap it in; raises ValueError if it is invalid."""
+    global _config_sig
+    sig, text = await asyncio.to_thread(_read_config_file)
+    _config_sig = sig  # a rejected file is not retried until it changes again
+    try:
+        cfg = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"not valid JSON: {e}") from None
+    _validate_config(cfg)
+
+    before = {c for c, _ in _all_targets()}
+    resolved = {r["source"]: sid for sid, r in _routes.items()}
+    _config.clear()  # runtime-owned keys are put back from memory by the next snapshot
+    _config.update({k: v for k, v in cfg.items() if k not in ("high_water", "unsent", "album_index")})
+    _apply_config(cfg)
+    _rebuild_routes(resolved)
+    after = {c for c, _ in _all_targets()}
+    for chat in before - after:
+        _health.pop(chat, None)
+
+    if _reload_bot is not None:
+        if any(not isinstance(_chatid(r["source"]), int) for r in routes_cfg.values()):
+            await resolve_routes(_reload_bot)
+        for chat in after - before:
+            await _assign_target(chat)
+    return (f"{len(after)} target(s) (+{len(after - before)} -{len(before - after)}), "
+            f"{len(_routes)} source(s)")
+
+async def _config_watcher():
+    while True:
+        await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+        if _save_task is not None and not _save_task.done():
+            continue  # our own write in progress
+        if _config_stat() in (_config_sig, None):
+            continue
+        try:
+            logger.info(f"config.json changed; reloaded: {await reload_config()}")
+        except ValueError as e:
+            logger.error(f"config.json changed but is invalid, keeping the running config: {e}")
+        except Exception as e:
+            logger.exception(f"config.json reload failed: {e}")
+
+def start_config_watcher(bot):
+    global _reload_bot, _reload_task
+    _reload_bot = bot
+    if CONFIG_RELOAD_INTERVAL > 0:
+        _reload_task = asyncio.get_running_loop().create_task(_config_watcher())
+
+def stop_config_watcher():
+    global _reload_bot
+    _reload_bot = None
+    if _reload_task is not None:
+        _reload_task.cancel()
+
+# ─── /reload: load config.json now ─────────────────
+async def reload(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if _config_stat() == _config_sig:
+        await flush_config()  # unchanged on disk: save pending command changes rather than revert them
+    try:
+        summary = await reload_config()
+    except ValueError as e:
+        return await update.message.reply_text(f"❌ config.json not loaded, keeping the running config: {e}")
+    await update.message.reply_text(f"✅ Reloaded config.json: {summary}")
+
+# ─── Startup ────────────────────────────────────────
+# Independent startup work overlaps: Telethon connect/auth and the source entities
+# are started by main() and run while PTB initializes (getMe); the HTTP server,
+# route resolution, bot pool and fan-out workers then start together in post_init.
+# Catch-up waits for Telethon and the routes; the target warm-up runs behind it.
+# /readyz says "starting" until the warm-up is done too; the per-phase times are
+# logged, as is the first delivery.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))  # parallel Telethon entity lookups
+_startup_phases = {}  # phase -> seconds
+_t_init = None        # perf_counter when main() started the application
+_ready_at = None      # perf_counter when startup finished, warm-up included
+_serving = False      # post_init is done: catch-up and ingest have started
+_telethon_task = None
+_warmup_task = None
+_first_response = False
+
+async def _timed(phase: str, coro):
+    t = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        _startup_phases[phase] = time.perf_counter() - t
+
+def _source_chats() -> list:
+    return list(dict.fromkeys(_chatid(r["source"]) for r in [default_route, *routes_cfg.values()] if r["source"]))
+
+async def _warm_entities(chats) -> int:
+    """Resolve `chats` for Telethon once, so the first post doesn't pay for it."""
+    chats = dict.fromkeys(chats)
+    slots = asyncio.Semaphore(WARMUP_CONCURRENCY)
+
+    async def warm(chat):
+        async with slots:
+            try:
+                await _mt_entity(chat)
+            except Exception as e:
+                logger.warning(f"Startup: Telethon cannot resolve {chat}: {e}")
+
+    await asyncio.gather(*(warm(c) for c in chats))
+    return len(chats)
+
+async def _start_telethon():
+    await _timed("telethon", history_client.connect())
+    if not await history_client.is_user_authorized():
+        raise RuntimeError("Telethon session is not authorized")
+    await _timed("sources", _warm_entities(_source_chats()))
+
+def _begin_telethon(loop):
+    """Start connecting Telethon on `loop` (which may not be running yet); once only."""
+    global _telethon_task
+    if _telethon_task is None:
+        _telethon_task = loop.create_task(_start_telethon())
+
+def _log_first_response():
+    global _first_response
+    _first_response = True
+    if _ready_at is not None:
+        now = time.perf_counter()
+        logger.info(f"Startup: first delivery {now - _T0:.2f}s after start, {now - _ready_at:.2f}s after ready")
+
+async def _warm_targets(targets):
+    await _timed("targets", _warm_entities(targets))
+    if _serving:  # post_init finished first
+        _mark_ready()
+
+def _mark_ready():
+    global _ready_at
+    _ready_at = time.perf_counter()
+    logger.info(f"Startup: ready {_ready_at - _T0:.2f}s after start ("
+                + ", ".join(f"{k} {v:.2f}s" for k, v in _startup_phases.items()) + ")")
+
+async def _post_init(application):
+    global _serving, _warmup_task
+    bot = application.bot
+    _startup_phases["ptb_init"] = time.perf_counter() - (_t_init or _T0)
+    _begin_telethon(asyncio.get_running_loop())  # no-op when main() started it
+    BOT_UP.set(1)
+    await asyncio.gather(
+        _timed("http", start_http_server()),
+        _timed("routes", resolve_routes(bot)),
+        _timed("bot_pool", start_bot_pool(bot)),
+        _timed("fanout", start_fanout()),
+    )
+    try:
+        await _telethon_task
+        # only /forward needs the targets in Telethon; catch-up doesn't wait for them
+        _warmup_task = asyncio.create_task(_warm_targets([c for c, _ in _all_targets()]))
+        await _timed("catch_up", catch_up(bot))
+        start_mtproto_ingest(bot)
+    except Exception as e:
+        logger.exception(f"Telethon connect failed at startup: {e}")
+    start_health_monitor(bot)
+    start_config_watcher(bot)
+    _serving = True
+    if _warmup_task is None or _warmup_task.done():  # else the warm-up marks it
+        _mark_ready()
+
+async def _post_shutdown(application):
+    BOT_UP.set(0)
+    if _warmup_task is not None:
+        _warmup_task.cancel()
+    stop_config_watcher()
+    stop_health_monitor()
+    stop_fanout()
+    await stop_bot_pool()
+    await stop_http_server()
+    await flush_config()
+    with contextlib.suppress(Exception):
+        await history_client.disconnect()
+    if _record_fh is not None:
+        _record_fh.close()
 
 # ─── Entrypoint ─────────────────────────────────────
 def main():
-    keep_alive()
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    global _t_init
+    _t_init = time.perf_counter()
+    _startup_phases["load"] = _t_init - _T0  # module body: config, routes, album index
+    # run_polling() runs on the current event loop; set it up now so Telethon
+    # connects while PTB initializes
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    _begin_telethon(loop)
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .base_file_url(BOT_API_FILE_URL)
+        .local_mode(BOT_API_LOCAL)
+        .get_updates_request(_TrackedGetUpdatesRequest(connection_pool_size=1))
+        .concurrent_updates(_SourceOrderedProcessor(UPDATE_CONCURRENCY))
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
     application.add_handler(CommandHandler("register", register))
-    application.add_handler(CommandHandler("forward", forward_history))
+    application.add_handler(CommandHandler("forward", _cancellable(forward_history)))
     application.add_handler(CommandHandler("increasepound", increasepound))
     application.add_handler(CommandHandler("increasecart", increasecart))
     application.add_handler(CommandHandler("targets", targets))        
-    application.add_handler(CommandHandler("prunetargets", prunetargets))
-    application.add_handler(CommandHandler("post", post))
-    application.add_handler(CommandHandler("postadj", postadj))
+    application.add_handler(CommandHandler("prunetargets", _cancellable(prunetargets)))
+    application.add_handler(CommandHandler("post", _cancellable(post)))
+    application.add_handler(CommandHandler("postadj", _cancellable(postadj)))
+    application.add_handler(CommandHandler("trace", trace))
+    application.add_handler(CommandHandler("routes", routes))
+    application.add_handler(CommandHandler("route", route))
+    application.add_handler(CommandHandler("unroute", unroute))
+    application.add_handler(CommandHandler("sender", sender))
+    application.add_handler(CommandHandler("priority", priority))
+    application.add_handler(CommandHandler("reload", reload))
+    if RECORD_UPDATES:
+        application.add_handler(TypeHandler(Update, record_update), group=-1)
+        logger.info(f"Recording source updates to {RECORD_UPDATES}")
     application.add_handler(MessageHandler(filters.ALL, forward_handler), group=1)
+    if WEBHOOK_URL:
+        logger.info(f"Bot up, receiving updates by webhook on {WEBHOOK_PATH}.")
+        try:
+            loop.run_until_complete(_run_webhook(application))
+        finally:
+            loop.close()
+        return
     logger.info("Bot up and entering polling loop.")
-    application.run_polling()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        loop.add_signal_handler(sig, _on_stop_signal, application)  # instead of PTB's, see "Graceful shutdown"
+    application.run_polling(stop_signals=None)
+
+async def _run_webhook(application):
+    """run_polling()'s lifecycle, with the updater replaced by the webhook route."""
+    global _webhook_app, _webhook_set
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    _webhook_app = application
+    await application.initialize()
+    try:
+        await _post_init(application)
+        await application.start()
+        await application.bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        _webhook_set = True
+        await stop.wait()
+    finally:
+        _stop_ingest()
+        _webhook_set = False
+        if _serving:
+            await shutdown_drain()  # before stop(), which waits for running handlers
+        if application.running:
+            await application.stop()
+            await _post_stop(application)
+        await application.shutdown()
+        await _post_shutdown(application)
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) in (3, 4) and sys.argv[1] == "--fanout-worker":
+        asyncio.run(run_fanout_worker(*map(int, sys.argv[2:])))
+    else:
+        main()
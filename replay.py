@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Replay a recording made with RECORD_UPDATES=... into the bot's handlers.
+
+Updates are fed through the Application's update queue with their original
+inter-arrival gaps divided by --speed (0 = as fast as possible), while all Bot
+API calls go to loadtest.FakeBotAPI. The report has the same shape as
+loadtest.py, so recorded traffic (e.g. bursts of 10-item albums) can be
+benchmarked offline against new versions of forward_handler / flush_media_group.
+
+    python replay.py recording.jsonl --speed 5 --targets 100 --latency-ms 40
+
+With --webhook the recording is instead POSTed to a running bot started with
+WEBHOOK_URL (and WEBHOOK_SECRET, passed here as --secret), to exercise
+webhook ingestion end to end:
+
+    python replay.py recording.jsonl --webhook http://127.0.0.1:8080/webhook --secret s3cret
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import logging
+import tempfile
+
+import loadtest
+
+
+def load_recording(path: str):
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    rows.sort(key=lambda r: r["t"])
+    return rows
+
+
+def _source_of(rows) -> str:
+    for r in rows:
+        post = r["update"].get("channel_post") or r["update"].get("edited_channel_post")
+        if post:
+            return str(post["chat"]["id"])
+    raise SystemExit("recording contains no channel posts")
+
+
+async def feed(rows, speed: float, put):
+    """Call `put(update_dict)` for each row, keeping recorded gaps scaled by 1/speed."""
+    t_first = rows[0]["t"]
+    start = time.monotonic()
+    for r in rows:
+        if speed > 0:
+            delay = (r["t"] - t_first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await put(r["update"])
+
+
+async def post_to_webhook(args, rows):
+    from aiohttp import ClientSession
+
+    status = {}
+    async with ClientSession(headers={"X-Telegram-Bot-Api-Secret-Token": args.secret}) as session:
+        async def put(data):
+            async with session.post(args.webhook, json=data) as resp:
+                status[resp.status] = status.get(resp.status, 0) + 1
+
+        t0 = time.perf_counter()
+        await feed(rows, args.speed, put)
+    print(f"posted {len(rows)} updates to {args.webhook} in {time.perf_counter() - t0:.1f}s; "
+          f"HTTP status counts: {status}")
+
+
+async def run(args):
+    rows = load_recording(args.recording)
+    if not rows:
+        raise SystemExit("empty recording")
+    if args.webhook:
+        return await post_to_webhook(args, rows)
+    posts = len({(r["update"].get("channel_post") or {}).get("media_group_id")
+                 or r["update"].get("update_id") for r in rows})
+
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    os.environ["SOURCE_CHANNEL"] = _source_of(rows)
+    os.environ["SEND_CONCURRENCY"] = str(args.send_concurrency)
+    os.environ["TRACE_FILE"] = os.path.join(workdir, "traces.jsonl")
+    main = loadtest.import_main(workdir)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if not args.verbose:
+        logging.getLogger("main").setLevel(logging.CRITICAL)
+
+    api = await loadtest.FakeBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_429, args.retry_after).start()
+    targets = [-1002000000000 - i for i in range(args.targets)]
+    main.target_chats[:] = targets
+    for chat in targets:
+        tc = main._target(chat)
+        tc.inc_pound, tc.inc_cart = main.THRESHOLD, 15
+
+    from telegram import Update
+    application = loadtest.build_application(main, api.base_url)
+    await application.initialize()
+    await application.start()
+    api.calls.clear()
+
+    async def put(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    t0 = time.perf_counter()
+    await feed(rows, args.speed, put)
+    await asyncio.sleep(0.1)
+    drained = await loadtest.wait_idle(main, args.timeout)
+    wall = time.perf_counter() - t0
+
+    await application.stop()
+    await application.shutdown()
+    await api.stop()
+    if not drained:
+        print(f"⚠️  lanes did not drain within {args.timeout}s; numbers below are partial")
+    recorded_span = rows[-1]["t"] - rows[0]["t"]
+    print(f"replayed {len(rows)} updates ({posts} posts) recorded over {recorded_span:.1f}s at speed={args.speed or 'max'}")
+    lags, failed = loadtest.read_trace_lags(os.environ["TRACE_FILE"])
+    args.posts = posts
+    args.album_size = "recorded"
+    loadtest.report(args, api, wall, lags, failed)
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("recording", help="JSONL file written with RECORD_UPDATES")
+    ap.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier, 0 = no pauses")
+    ap.add_argument("--targets", type=int, default=100)
+    ap.add_argument("--latency-ms", type=float, default=50.0)
+    ap.add_argument("--jitter-ms", type=float, default=15.0)
+    ap.add_argument("--rate-429", type=float, default=0.0)
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--send-concurrency", type=int, default=int(os.getenv("SEND_CONCURRENCY", "8")))
+    ap.add_argument("--timeout", type=float, default=600.0)
+    ap.add_argument("--webhook", help="POST the updates to this running bot's webhook URL instead")
+    ap.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""), help="webhook secret token")
+    ap.add_argument("--verbose", action="store_true", help="keep the bot's own log output")
+    return ap.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))